@@ -31,12 +31,376 @@ with open(r'./pythonTest.txt') as f:
         print(line, end='')
         print('-' * 30)
 
+# 对于很大的、基本只追加写入的文件，每次调用 search() 都要从头扫描一遍。
+# 可以用 mmap 映射文件，建立一个行偏移索引和一个单词到行号的倒排索引，并保存到磁盘上。
+# 查询一个单词时直接跳到匹配的行；文件变长之后只需要为新增的部分建立索引。
+# 索引文件可能和日志一样放在共享目录里，所以不用 pickle，而是存成一行 JSON 头加上数组的原始字节，
+# 读取时校验大小，任何不对的地方都当作没有索引，重新建立。
+# 文件变长时不重写整个索引，只把新增的行偏移和倒排项作为一条增量记录追加到索引文件末尾，
+# 增量记录攒多了才整体重写一次：
+import hashlib
+import json
+import mmap
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class LineIndex:
+    _token = re.compile(rb'\w+')
+    # Rewrite the index file in one piece once it holds this many records
+    _MAX_RECORDS = 64
+
+    def __init__(self, filename, indexfile=None, encoding='utf-8'):
+        self.filename = filename
+        self.indexfile = indexfile or filename + '.idx'
+        self.encoding = encoding
+        self._reset()
+        if os.path.exists(self.indexfile):
+            self._load()
+        self.update()
+
+    def _reset(self):
+        self.offsets = array('Q')   # Start offset of every indexed line
+        self.postings = {}          # token -> array of line numbers
+        self.end = 0                # End of the last complete line indexed
+        self.check = b''            # Digest of the bytes just before end
+        self._size = None           # Length of the valid part of the index file, None to rewrite it
+        self._records = 0
+
+    def _checksum(self, mm):
+        return hashlib.sha1(mm[max(0, self.end - 4096):self.end]).digest()
+
+    def update(self):
+        '''
+        Index any complete lines appended since the last update. The whole
+        index is rebuilt if the previously indexed part of the file changed.
+        '''
+        if os.path.getsize(self.filename) == 0:
+            self._reset()
+            return
+        with open(self.filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < self.end or self._checksum(mm) != self.check:
+                self._reset()
+            first = len(self.offsets)
+            touched = set()
+            pos = self.end
+            while True:
+                nl = mm.find(b'\n', pos)
+                if nl < 0:
+                    break
+                lineno = len(self.offsets)
+                self.offsets.append(pos)
+                for token in set(self._token.findall(mm, pos, nl)):
+                    self.postings.setdefault(token, array('I')).append(lineno)
+                    touched.add(token)
+                pos = nl + 1
+            if pos != self.end:
+                self.end = pos
+                self.check = self._checksum(mm)
+                if self._size is None or self._records >= self._MAX_RECORDS:
+                    self.save()
+                else:
+                    self._append(first, touched)
+
+    _MAGIC = b'LINEINDEX 2\n'
+
+    def _write_record(self, f, offsets, postings):
+        # A record holds the lines indexed since the previous record and the new end
+        header = {'byteorder': sys.byteorder, 'end': self.end, 'check': self.check.hex(),
+                  'lines': len(offsets),
+                  'tokens': [[token.decode('latin-1'), len(linenos)] for token, linenos in postings.items()]}
+        f.write(json.dumps(header).encode('ascii') + b'\n')
+        offsets.tofile(f)
+        for linenos in postings.values():
+            linenos.tofile(f)
+        self._records += 1
+
+    def save(self):
+        '''
+        Write the whole index as a single record
+        '''
+        self._records = 0
+        with open(self.indexfile, 'wb') as f:
+            f.write(self._MAGIC)
+            self._write_record(f, self.offsets, self.postings)
+            self._size = f.tell()
+
+    def _append(self, first, tokens):
+        # Only the lines from number first on are new
+        postings = {}
+        for token in tokens:
+            linenos = self.postings[token]
+            postings[token] = linenos[bisect_left(linenos, first):]
+        with open(self.indexfile, 'r+b') as f:
+            # Drop anything after the last good record, e.g. one cut short by a crash
+            f.seek(self._size)
+            f.truncate()
+            self._write_record(f, self.offsets[first:], postings)
+            self._size = f.tell()
+
+    @staticmethod
+    def _read_array(f, typecode, n):
+        items = array(typecode)
+        items.frombytes(f.read(n * items.itemsize))
+        if len(items) != n:
+            raise ValueError('Truncated index')
+        return items
+
+    def _load(self):
+        offsets = array('Q')
+        postings = {}
+        end = 0
+        check = b''
+        records = 0
+        try:
+            with open(self.indexfile, 'rb') as f:
+                if f.readline() != self._MAGIC:
+                    raise ValueError('Not an index file')
+                size = f.tell()
+                while True:
+                    line = f.readline()
+                    if not line:
+                        break
+                    try:
+                        header = json.loads(line)
+                        if header['byteorder'] != sys.byteorder:
+                            raise ValueError('Index written on another platform')
+                        new_offsets = self._read_array(f, 'Q', header['lines'])
+                        new_postings = [(token.encode('latin-1'), self._read_array(f, 'I', n))
+                                        for token, n in header['tokens']]
+                        new_end = header['end']
+                        new_check = bytes.fromhex(header['check'])
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        if records:
+                            # The last record was cut short: keep the ones before it
+                            break
+                        raise
+                    offsets.extend(new_offsets)
+                    for token, linenos in new_postings:
+                        postings.setdefault(token, array('I')).extend(linenos)
+                    end, check = new_end, new_check
+                    records += 1
+                    size = f.tell()
+            if not records:
+                raise ValueError('Empty index')
+            if not isinstance(end, int) or end < 0 or (offsets and offsets[-1] >= end):
+                raise ValueError('Inconsistent index')
+            if any(linenos and max(linenos) >= len(offsets) for linenos in postings.values()):
+                raise ValueError('Inconsistent index')
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # Unreadable or tampered with: update() rebuilds it from scratch
+            return
+        self.offsets, self.postings, self.end, self.check = offsets, postings, end, check
+        self._size, self._records = size, records
+
+    def _decode(self, line):
+        # Translate the line ending as text mode does
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        elif line.endswith(b'\r'):
+            line = line[:-1] + b'\n'
+        return line.decode(self.encoding)
+
+    def _linenos(self, mm, pattern):
+        if self._token.fullmatch(pattern):
+            # Any occurrence of a word pattern lies inside a token containing it
+            linenos = set()
+            for token, postings in self.postings.items():
+                if pattern in token:
+                    linenos.update(postings)
+            return sorted(linenos)
+        linenos = []
+        pos = mm.find(pattern, 0, self.end)
+        while pos >= 0:
+            lineno = bisect_right(self.offsets, pos) - 1
+            linenos.append(lineno)
+            nextline = lineno + 1
+            pos = mm.find(pattern, self.offsets[nextline] if nextline < len(self.offsets) else self.end,
+                          self.end)
+        return linenos
+
+    def search(self, pattern, history=5):
+        '''
+        Same results as search(open(filename), pattern, history), using the index.
+        Lines end in \n or \r\n; a lone \r is not treated as a line break.
+        '''
+        self.update()
+        previous_lines = deque(maxlen=history)
+        if os.path.getsize(self.filename) == 0:
+            return
+        bpattern = pattern.encode(self.encoding)
+        with open(self.filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for lineno in self._linenos(mm, bpattern):
+                start = self.offsets[lineno]
+                stop = self.offsets[lineno + 1] if lineno + 1 < len(self.offsets) else self.end
+                line = self._decode(mm[start:stop])
+                previous_lines.append(line)
+                yield line, previous_lines
+            # A final line without a newline is not indexed yet
+            if bpattern in mm[self.end:]:
+                line = self._decode(mm[self.end:])
+                previous_lines.append(line)
+                yield line, previous_lines
+
+# index = LineIndex('./pythonTest.txt')
+# for line, prevlines in index.search('python', 3):
+#     ...
+
+# 如果只关心最近的N个匹配(4.6节中 linehistory 的场景也一样)，完全没必要从文件开头读起。
+# 可以从文件末尾开始按对齐的大块向前读，反向切分出每一行，找到N个匹配就停止。
+# tail_search() 的输出和 search() 一样，follow=True 时还会像 tail -f 那样继续等待新追加的行：
+import time
+
+
+def reverse_lines(f, blocksize=64 * 1024):
+    '''
+    Produce the lines of a binary file from last to first
+    '''
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    head = b''          # Start of a line that began in an earlier block
+    newline = b''       # The last line of the file may lack a newline
+    while pos > 0:
+        # Read the unaligned remainder first so that later reads are aligned
+        size = pos % blocksize or blocksize
+        pos -= size
+        f.seek(pos)
+        pieces = (f.read(size) + head).split(b'\n')
+        head = pieces[0]
+        for piece in reversed(pieces[1:]):
+            if piece or newline:
+                yield piece + newline
+            newline = b'\n'
+    if head or newline:
+        yield head + newline
+
+
+def tail_search(filename, pattern, history=5, follow=False, blocksize=64 * 1024,
+                encoding='utf-8', interval=1.0):
+    with open(filename, 'rb') as f:
+        bpattern = pattern.encode(encoding)
+        matches = []
+        # history=0 means no backlog at all, so don't scan the file backwards
+        if history > 0:
+            for line in reverse_lines(f, blocksize):
+                if bpattern in line:
+                    matches.append(line)
+                    if len(matches) == history:
+                        break
+        previous_lines = deque(maxlen=history)
+        for line in reversed(matches):
+            line = line.decode(encoding)
+            previous_lines.append(line)
+            yield line, previous_lines
+
+        if not follow:
+            return
+        f.seek(0, os.SEEK_END)
+        partial = b''
+        while True:
+            data = f.read()
+            if not data:
+                time.sleep(interval)
+                continue
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                if bpattern in line:
+                    line = (line + b'\n').decode(encoding)
+                    previous_lines.append(line)
+                    yield line, previous_lines
+
 # 1.4 查找最大或最小的 N 个元素
 import heapq
 nums = [1, 8, 2, 23, 7, -4, 18, 23, 42, 37, 2]
 print(heapq.nlargest(3, nums)) # Prints [42, 37, 23]
 print(heapq.nsmallest(3, nums)) # Prints [-4, 1, 2]
 
+# nlargest()/nsmallest() 需要一次拿到所有数据。对于放不进内存的数据流，或者分散在多个分片上的数据，
+# 可以用一个固定大小为 k 的堆来累积结果：堆顶是目前第 k 大的元素，比它小的新元素直接丢弃。
+# 每个进程的 TopK 对象都可以 pickle 之后发回来用 merge() 合并。
+# 如果安装了 NumPy，add_many() 对数值数组会先用 argpartition() 选出这一批的前 k 个：
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class _Reversed:
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class TopK:
+    def __init__(self, k, key=None, largest=True):
+        self.k = k
+        self.key = key
+        self.largest = largest
+        # Min-heap of (key, -seq, item), so the weakest entry is on top and
+        # among equal keys the item seen first is kept, as nlargest() does
+        self._heap = []
+        self._seq = 0
+
+    def _entry(self, item):
+        value = item if self.key is None else self.key(item)
+        if not self.largest:
+            value = _Reversed(value)
+        self._seq += 1
+        return (value, -self._seq, item)
+
+    def _push(self, entry):
+        heap = self._heap
+        if len(heap) < self.k:
+            heapq.heappush(heap, entry)
+        elif heap and heap[0] < entry:
+            heapq.heapreplace(heap, entry)
+
+    def add(self, item):
+        self._push(self._entry(item))
+
+    def add_many(self, items):
+        if self.k <= 0:
+            # Nothing is kept, as with nlargest(0, ...)
+            return
+        if (np is not None and isinstance(items, np.ndarray) and self.key is None
+                and items.ndim == 1 and items.dtype.kind in 'iuf' and len(items) > self.k):
+            # Only the k best of this batch can make it into the heap
+            if self.largest:
+                best = np.argpartition(items, len(items) - self.k)[-self.k:]
+            else:
+                best = np.argpartition(items, self.k - 1)[:self.k]
+            items = items[np.sort(best)].tolist()
+        for item in items:
+            self._push(self._entry(item))
+
+    def merge(self, other):
+        '''
+        Combine the partial result of another TopK (e.g. from another process)
+        '''
+        for value, seq, item in sorted(other._heap, key=lambda entry: -entry[1]):
+            self.add(item)
+        return self
+
+    def result(self):
+        return [item for value, seq, item in sorted(self._heap, reverse=True)]
+
+
+top = TopK(3)
+for n in nums:
+    top.add(n)
+print(top.result())  # Prints [42, 37, 23]
+
 
 # 1.5 实现一个优先级队列
 
@@ -70,6 +434,270 @@ print(q.pop())
 print(q.pop())
 print(q.pop())
 
+# PriorityQueue 不能修改已经入队元素的优先级，只能重复 push 再跳过过期的条目，堆会越来越大。
+# 下面的 IndexedPriorityQueue 中 push() 会返回一个句柄，可以用它来修改优先级或者删除元素。
+# 优先级、序号和元素分别保存在三个并行的数组里，而不是每个条目一个元组；push_many() 用 O(n) 的方式建堆。
+# 优先级必须是数字，优先级相同的元素仍然按入队顺序出队：
+
+
+class IndexedPriorityQueue:
+    def __init__(self):
+        self._priority = array('d')     # Heap ordered by (-priority, seq)
+        self._seq = array('q')
+        self._items = []
+        self._pos = {}                  # handle (seq) -> position in the heap
+        self._index = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def _place(self, i, priority, seq, item):
+        self._priority[i] = priority
+        self._seq[i] = seq
+        self._items[i] = item
+        self._pos[seq] = i
+
+    def _sift_up(self, i):
+        # Move the entry at i up, shifting parents down into the hole it leaves
+        prio, seqs, items = self._priority, self._seq, self._items
+        p, s, item = prio[i], seqs[i], items[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            pp = prio[parent]
+            if p < pp or (p == pp and s > seqs[parent]):
+                break
+            self._place(i, pp, seqs[parent], items[parent])
+            i = parent
+        self._place(i, p, s, item)
+
+    def _sift_down(self, i):
+        prio, seqs, items = self._priority, self._seq, self._items
+        n = len(items)
+        p, s, item = prio[i], seqs[i], items[i]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            right = child + 1
+            if right < n and (prio[right] > prio[child] or
+                              (prio[right] == prio[child] and seqs[right] < seqs[child])):
+                child = right
+            pc = prio[child]
+            if p > pc or (p == pc and s < seqs[child]):
+                break
+            self._place(i, pc, seqs[child], items[child])
+            i = child
+        self._place(i, p, s, item)
+
+    def _append(self, item, priority):
+        # Append the priority first: it raises TypeError for a non-number, and
+        # nothing else may change in that case
+        handle = self._index
+        self._priority.append(priority)
+        self._seq.append(handle)
+        self._items.append(item)
+        self._pos[handle] = len(self._items) - 1
+        self._index += 1
+        return handle
+
+    def push(self, item, priority):
+        handle = self._append(item, priority)
+        self._sift_up(len(self._items) - 1)
+        return handle
+
+    def push_many(self, pairs):
+        '''
+        Push (item, priority) pairs and restore the heap in O(n). Returns the handles.
+        '''
+        try:
+            handles = [self._append(item, priority) for item, priority in pairs]
+        finally:
+            # Keep the pairs appended before a bad one in heap order
+            for i in reversed(range(len(self._items) // 2)):
+                self._sift_down(i)
+        return handles
+
+    def peek(self):
+        return self._items[0]
+
+    def pop(self):
+        return self._remove_at(0)
+
+    def remove(self, handle):
+        return self._remove_at(self._pos[handle])
+
+    def _remove_at(self, i):
+        item = self._items[i]
+        del self._pos[self._seq[i]]
+        priority, seq, last = self._priority.pop(), self._seq.pop(), self._items.pop()
+        if i < len(self._items):
+            # Fill the hole with the last entry and restore the heap around it
+            self._place(i, priority, seq, last)
+            self._sift_up(i)
+            self._sift_down(self._pos[seq])
+        return item
+
+    def update_priority(self, handle, priority):
+        i = self._pos[handle]
+        self._priority[i] = priority
+        self._sift_up(i)
+        self._sift_down(self._pos[handle])
+
+
+# 下面比较两种做法：原来的做法在修改优先级时重新 push 一次，出队时跳过过期的条目
+import random
+import tracemalloc
+
+
+def bench_priority_queues(njobs=100000, nupdates=200000):
+    jobs = [(n, random.random()) for n in range(njobs)]
+    updates = [(random.randrange(njobs), random.random()) for n in range(nupdates)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    heap = [(-priority, n, n) for n, priority in jobs]
+    heapq.heapify(heap)
+    current = dict(jobs)
+    index = njobs
+    for n, priority in updates:
+        current[n] = priority
+        heapq.heappush(heap, (-priority, index, n))
+        index += 1
+    peak = tracemalloc.get_traced_memory()[1]
+    order = []
+    while heap:
+        priority, index, n = heapq.heappop(heap)
+        if n in current and current[n] == -priority:
+            del current[n]
+            order.append(n)
+    print('heapq + stale entries: {:.2f}s, peak {:.1f} MB'.format(
+        time.perf_counter() - start, peak / 2**20))
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    q = IndexedPriorityQueue()
+    handles = q.push_many((n, priority) for n, priority in jobs)
+    for n, priority in updates:
+        q.update_priority(handles[n], priority)
+    peak = tracemalloc.get_traced_memory()[1]
+    indexed = [q.pop() for n in range(len(q))]
+    print('IndexedPriorityQueue:  {:.2f}s, peak {:.1f} MB'.format(
+        time.perf_counter() - start, peak / 2**20))
+    tracemalloc.stop()
+    assert len(order) == len(indexed) == njobs
+
+# PriorityQueue 也不能在多个线程之间共享，而且没有异步接口。下面是两个包装了它的变体：
+# 一个是阻塞的线程安全版本，支持 get(timeout=) 和容量上限；另一个是 asyncio 版本，get()/put() 都可以 await。
+# 它们内部使用 PriorityQueue 的 push()/pop()，所以同优先级的元素仍然按 _index 先进先出。
+# 这里用组合而不是继承，否则绕过锁、容量上限和通知的 push()/pop() 也会成为公开接口：
+import asyncio
+import threading
+from queue import Empty, Full
+
+
+class BlockingPriorityQueue:
+    def __init__(self, maxsize=0):
+        self._heap = PriorityQueue()
+        self.maxsize = maxsize
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+
+    def __len__(self):
+        return len(self._heap._queue)
+
+    def _full(self):
+        return 0 < self.maxsize <= len(self._heap._queue)
+
+    def put(self, item, priority, timeout=None):
+        with self._not_full:
+            if not self._not_full.wait_for(lambda: not self._full(), timeout):
+                raise Full
+            self._heap.push(item, priority)
+            self._not_empty.notify()
+
+    def get(self, timeout=None):
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._heap._queue, timeout):
+                raise Empty
+            item = self._heap.pop()
+            self._not_full.notify()
+            return item
+
+
+class AsyncPriorityQueue:
+    def __init__(self, maxsize=0):
+        self._heap = PriorityQueue()
+        self.maxsize = maxsize
+        lock = asyncio.Lock()
+        self._not_empty = asyncio.Condition(lock)
+        self._not_full = asyncio.Condition(lock)
+
+    def __len__(self):
+        return len(self._heap._queue)
+
+    def _full(self):
+        return 0 < self.maxsize <= len(self._heap._queue)
+
+    async def put(self, item, priority):
+        async with self._not_full:
+            await self._not_full.wait_for(lambda: not self._full())
+            self._heap.push(item, priority)
+            self._not_empty.notify()
+
+    async def get(self):
+        async with self._not_empty:
+            await self._not_empty.wait_for(lambda: self._heap._queue)
+            item = self._heap.pop()
+            self._not_full.notify()
+            return item
+
+
+# 多个生产者和多个消费者同时使用队列时的吞吐量：
+def bench_concurrent_queues(nitems=100000, nproducers=8, nconsumers=8, maxsize=1000):
+    q = BlockingPriorityQueue(maxsize)
+    per_producer = nitems // nproducers
+
+    def producer():
+        for n in range(per_producer):
+            q.put(n, random.random())
+
+    def consumer(count):
+        for n in range(count):
+            q.get()
+
+    counts = [per_producer * nproducers // nconsumers] * nconsumers
+    counts[-1] += per_producer * nproducers - sum(counts)
+    threads = [threading.Thread(target=producer) for n in range(nproducers)]
+    threads += [threading.Thread(target=consumer, args=(count,)) for count in counts]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print('BlockingPriorityQueue: {:.0f} items/s'.format(
+        per_producer * nproducers / (time.perf_counter() - start)))
+
+    async def main():
+        q = AsyncPriorityQueue(maxsize)
+
+        async def producer():
+            for n in range(per_producer):
+                await q.put(n, random.random())
+
+        async def consumer(count):
+            for n in range(count):
+                await q.get()
+
+        await asyncio.gather(*[producer() for n in range(nproducers)],
+                             *[consumer(count) for count in counts])
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    print('AsyncPriorityQueue:    {:.0f} items/s'.format(
+        per_producer * nproducers / (time.perf_counter() - start)))
+
 # 1.6 字典中的键映射多个值
 from collections import defaultdict
 from collections import defaultdict
@@ -150,6 +778,102 @@ def dedupe(items, key=None):
 a = [{'x': 1, 'y': 2}, {'x': 1, 'y': 3}, {'x': 1, 'y': 2}, {'x': 2, 'y': 4}]
 print(list(dedupe(a, key=lambda d: (d['x'],d['y']))))
 
+# dedupe() 会永远记住见过的每一个键，对于非常长的数据流内存迟早会耗尽。下面是三种内存有上限的做法：
+# dedupe_window() 在 maxitems 个元素或 maxage 秒之后就忘掉一个键；
+# dedupe_bloom() 使用布隆过滤器，可以设置误判率，被误判的元素会被当成重复而丢掉；
+# dedupe_hashed() 只保存键的64位摘要而不是键本身，要求键的 repr() 是稳定的(比如由字符串和数字组成的元组)：
+import math
+
+
+def dedupe_window(items, key=None, maxitems=None, maxage=None, clock=time.monotonic):
+    seen = {}                   # val -> position when first seen
+    window = deque()            # (position, time, val) in the order first seen
+    for n, item in enumerate(items):
+        now = clock() if maxage is not None else 0
+        # Forget the keys that have fallen out of the window
+        while window and ((maxitems is not None and n - window[0][0] >= maxitems) or
+                          (maxage is not None and now - window[0][1] >= maxage)):
+            pos, when, val = window.popleft()
+            del seen[val]
+        val = item if key is None else key(item)
+        if val not in seen:
+            yield item
+            seen[val] = n
+            window.append((n, now, val))
+
+
+def _digest64(val):
+    return int.from_bytes(hashlib.blake2b(repr(val).encode(), digest_size=8).digest(), 'little')
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        nbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.nbits = nbits
+        self.nhashes = max(1, round(nbits / capacity * math.log(2)))
+        self.bits = bytearray((nbits + 7) // 8)
+
+    def add(self, val):
+        '''
+        Add val, returning True if it was (probably) already present
+        '''
+        # Derive all of the hash functions from one digest (double hashing)
+        digest = hashlib.blake2b(repr(val).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        bits, nbits = self.bits, self.nbits
+        present = True
+        for i in range(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                present = False
+                bits[pos >> 3] |= mask
+        return present
+
+
+def dedupe_bloom(items, key=None, capacity=1000000, error_rate=0.001):
+    seen = BloomFilter(capacity, error_rate)
+    for item in items:
+        val = item if key is None else key(item)
+        if not seen.add(val):
+            yield item
+
+
+def dedupe_hashed(items, key=None):
+    seen = set()
+    for item in items:
+        val = _digest64(item if key is None else key(item))
+        if val not in seen:
+            yield item
+            seen.add(val)
+
+
+print(list(dedupe_window(a, key=lambda d: (d['x'], d['y']), maxitems=2)))
+print(list(dedupe_bloom(a, key=lambda d: (d['x'], d['y']), capacity=100)))
+print(list(dedupe_hashed(a, key=lambda d: (d['x'], d['y']))))
+
+
+def bench_dedupe(nitems=500000, ndistinct=200000):
+    rows = [{'user': 'user{}'.format(n), 'url': '/page/{}'.format(n % 1000)}
+            for n in random.choices(range(ndistinct), k=nitems)]
+    key = lambda d: (d['user'], d['url'])
+    modes = [('dedupe', lambda: dedupe(rows, key)),
+             ('dedupe_window', lambda: dedupe_window(rows, key, maxitems=10000)),
+             ('dedupe_bloom', lambda: dedupe_bloom(rows, key, capacity=ndistinct)),
+             ('dedupe_hashed', lambda: dedupe_hashed(rows, key))]
+    for name, run in modes:
+        start = time.perf_counter()
+        count = sum(1 for item in run())
+        elapsed = time.perf_counter() - start
+        # Measure memory in a second run since tracing slows everything down
+        tracemalloc.start()
+        sum(1 for item in run())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:14} {:8} unique  {:8.0f} items/s  peak {:6.1f} MB'.format(
+            name, count, nitems / elapsed, peak / 2**20))
+
 # 1.11 命名切片
 record = '....................100 .......513.25 ..........'
 SHARES = slice(20, 23)
@@ -171,6 +895,119 @@ top_three = word_counts.most_common(3)
 print(top_three)
 # Outputs [('eyes', 8), ('the', 5), ('look', 4)]
 
+# Counter 为每个不同的元素都保存一个精确的计数，对于URL、User-Agent这种取值非常多的数据流，
+# 这个字典会变得非常大。如果只关心出现次数最多的那些元素，可以使用 Space-Saving 算法：
+# 最多只保存 1/epsilon 个计数器，新元素到来而计数器已满时，替换掉计数最小的那个，并继承它的计数作为误差。
+# 每个计数最多比真实值大 epsilon * N (N是元素总数)，most_common() 会同时给出这个误差。
+# 两个 HeavyHitters 对象可以用 merge() 合并，误差上界保持不变：
+import itertools
+import math
+
+
+class HeavyHitters:
+    def __init__(self, epsilon=0.001):
+        self.capacity = math.ceil(1 / epsilon)
+        self.total = 0
+        self._counts = {}       # item -> count (an overestimate)
+        self._errors = {}       # item -> maximum overestimate
+        self._heap = []         # (count, seq, item) entries, some of them out of date
+        self._seq = itertools.count()   # Breaks ties, so items never need to be ordered
+
+    def _min_item(self):
+        # Pop out of date heap entries until the top matches its current count
+        heap = self._heap
+        while True:
+            count, seq, item = heap[0]
+            current = self._counts.get(item)
+            if current == count:
+                return item
+            if current is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (current, next(self._seq), item))
+
+    def update(self, items):
+        counts = self._counts
+        for item in items:
+            self.total += 1
+            if item in counts:
+                counts[item] += 1
+            elif len(counts) < self.capacity:
+                counts[item] = 1
+                self._errors[item] = 0
+                heapq.heappush(self._heap, (1, next(self._seq), item))
+            else:
+                victim = self._min_item()
+                floor = counts.pop(victim)
+                del self._errors[victim]
+                counts[item] = floor + 1
+                self._errors[item] = floor
+                heapq.heapreplace(self._heap, (floor + 1, next(self._seq), item))
+
+    def merge(self, other):
+        '''
+        Combine with the summary of another stream (e.g. from another process)
+        '''
+        # An item missing from a full summary may have occurred up to its minimum count
+        mins = [min(hh._counts.values()) if len(hh._counts) >= hh.capacity else 0
+                for hh in (self, other)]
+        merged = {}
+        for item in self._counts.keys() | other._counts.keys():
+            count = error = 0
+            for hh, floor in zip((self, other), mins):
+                count += hh._counts.get(item, floor)
+                error += hh._errors.get(item, floor)
+            merged[item] = (count, error)
+        keep = heapq.nlargest(self.capacity, merged.items(), key=lambda kv: kv[1][0])
+        self.total += other.total
+        self._counts = {item: count for item, (count, error) in keep}
+        self._errors = {item: error for item, (count, error) in keep}
+        self._heap = [(count, next(self._seq), item) for item, count in self._counts.items()]
+        heapq.heapify(self._heap)
+        return self
+
+    def most_common(self, n=None):
+        '''
+        List the n most common items as (item, count, error) tuples. The true
+        count lies between count - error and count.
+        '''
+        if n is None:
+            n = len(self._counts)
+        top = heapq.nlargest(n, self._counts.items(), key=lambda kv: kv[1])
+        return [(item, count, self._errors[item]) for item, count in top]
+
+
+word_hitters = HeavyHitters(epsilon=0.2)
+word_hitters.update(words)
+print(word_hitters.most_common(3))
+
+
+# 下面在一个服从 Zipf 分布的数据流上比较 HeavyHitters 和 Counter 的准确度与内存：
+def bench_heavy_hitters(nitems=1000000, ndistinct=200000, epsilon=0.0005, n=20):
+    weights = [1 / rank for rank in range(1, ndistinct + 1)]
+    stream = ['/page/{}'.format(i) for i in random.choices(range(ndistinct), weights, k=nitems)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    exact = Counter(stream)
+    elapsed = time.perf_counter() - start
+    print('Counter:      {:.2f}s, {:.1f} MB'.format(elapsed, tracemalloc.get_traced_memory()[0] / 2**20))
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    hh = HeavyHitters(epsilon)
+    hh.update(stream)
+    elapsed = time.perf_counter() - start
+    print('HeavyHitters: {:.2f}s, {:.1f} MB'.format(elapsed, tracemalloc.get_traced_memory()[0] / 2**20))
+    tracemalloc.stop()
+
+    expected = [item for item, count in exact.most_common(n)]
+    found = [item for item, count, error in hh.most_common(n)]
+    worst = max(count - exact[item] for item, count, error in hh.most_common(n))
+    print('top {} recall: {:.0%}, worst overestimate {} (bound {:.0f})'.format(
+        n, len(set(expected) & set(found)) / n, worst, epsilon * nitems))
+
 # 1.13 通过某个关键字排序一个字典列表
 rows = [
     {'fname': 'Brian', 'lname': 'Jones', 'uid': 1003},
@@ -231,6 +1068,152 @@ for date, items in groupby(rows, key=itemgetter('date')):
     for i in items:
         print(' ', i)
 
+# rows.sort() 要求所有记录都能放进内存。对于更大的数据，可以使用外部归并排序：
+# 每读入 memory 字节左右的记录就排好序写到一个临时文件里，最后用 heapq.merge() (见4.15节)
+# 把这些有序的文件合并起来，再交给 groupby() 分组。合并时每个文件每次只读入一小块记录。
+# 同时合并的文件数受内存预算和可打开文件数的限制，文件太多时先分几轮合并成较少的大文件：
+import pickle
+import sys
+import tempfile
+from itertools import islice
+
+_SPILL_ROWS = 100
+
+
+def _approx_size(row):
+    size = sys.getsizeof(row)
+    if isinstance(row, dict):
+        size += sum(sys.getsizeof(value) for value in row.values())
+    return size
+
+
+def _max_open_files():
+    try:
+        import resource
+    except ImportError:
+        return 512
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return 4096 if soft == resource.RLIM_INFINITY else soft
+
+
+def _merge_fanin(memory, rowsize):
+    # Merging holds one chunk per input in memory and one open file per input plus the output,
+    # leaving half of the file descriptors for the rest of the program
+    fanin = int(memory // (rowsize * _SPILL_ROWS))
+    return max(2, min(fanin, _max_open_files() // 2 - 1))
+
+
+def _spill(rows, tmpdir):
+    # Runs are kept as closed files, so only the runs being merged hold a descriptor
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    with open(fd, 'wb') as f:
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, _SPILL_ROWS))
+            if not chunk:
+                break
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            yield from chunk
+
+
+def external_sort(rows, key=None, memory=64 * 2**20, tmpdir=None, fanin=None):
+    '''
+    Sort an iterable of rows using about memory bytes, spilling sorted runs
+    to temporary files. Like sorted(), the sort is stable. At most fanin runs
+    are merged at once (by default derived from memory and the open file limit).
+    '''
+    # Checked here rather than in the generator, so bad arguments fail at the call
+    if fanin is not None and fanin < 2:
+        raise ValueError('fanin must be at least 2, got {!r}'.format(fanin))
+    return _external_sort(rows, key, memory, tmpdir, fanin)
+
+
+def _external_sort(rows, key, memory, tmpdir, fanin):
+    paths = []
+    runs = []
+    buf = []
+    size = 0
+    total = 0
+    nrows = 0
+    try:
+        for row in rows:
+            buf.append(row)
+            rowsize = _approx_size(row)
+            size += rowsize
+            total += rowsize
+            nrows += 1
+            if size >= memory:
+                buf.sort(key=key)
+                runs.append(_spill(buf, tmpdir))
+                paths.append(runs[-1])
+                buf = []
+                size = 0
+        buf.sort(key=key)
+        if not runs:
+            yield from buf
+            return
+        # Spill the last run as well, so the final merge only holds one chunk per run
+        runs.append(_spill(buf, tmpdir))
+        paths.append(runs[-1])
+        buf = []
+        if fanin is None:
+            fanin = _merge_fanin(memory, total / nrows)
+        while len(runs) > fanin:
+            # Merge neighbouring runs in order, and heapq.merge() prefers earlier
+            # inputs on ties, so the sort stays stable
+            merged = []
+            for n in range(0, len(runs), fanin):
+                group = runs[n:n + fanin]
+                merged.append(_spill(heapq.merge(*[_read_run(path) for path in group], key=key), tmpdir))
+                paths.append(merged[-1])
+                for path in group:
+                    os.remove(path)
+            runs = merged
+        yield from heapq.merge(*[_read_run(path) for path in runs], key=key)
+    finally:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def external_groupby(rows, key, memory=64 * 2**20, tmpdir=None):
+    return groupby(external_sort(rows, key, memory, tmpdir), key=key)
+
+
+for date, items in external_groupby(rows, key=itemgetter('date'), memory=1024):
+    print(date, len(list(items)))
+
+
+def bench_external_sort(nrows=2000000, memory=16 * 2**20):
+    '''
+    Group rows generated on the fly by date, with memory much smaller than the data
+    '''
+    def gen_rows():
+        for n in range(nrows):
+            yield {'address': '{} N CLARK'.format(random.randrange(10000)),
+                   'date': '07/{:02d}/2012'.format(random.randrange(1, 32))}
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    ngroups = sum(1 for date, items in external_groupby(gen_rows(), itemgetter('date'), memory))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{} rows, {} groups: {:.2f}s, peak {:.1f} MB (budget {:.1f} MB)'.format(
+        nrows, ngroups, elapsed, peak / 2**20, memory / 2**20))
+
 # 1.16 过滤序列元素
 mylist = [1, 4, -5, 10, -7, 2, 3, -1]
 print([n for n in mylist if n > 0])
@@ -256,6 +1239,346 @@ tech_names = {'AAPL', 'IBM', 'HPQ', 'MSFT'}
 p2 = {key: value for key, value in prices.items() if key in tech_names}
 print(p1, p2)
 
+# 上面这些记录(1.13 和 1.15 节的 rows、这里的 prices)都是每行一个字典，每行要占用几百字节。
+# 行数很多时可以改成按列存储：数值列是一个 array，字符串列保存为整数编码的 array 加上一个不重复取值的列表。
+# 筛选、排序和分组都先算出一个下标数组再一次性取出各列。如果安装了 NumPy，这些操作直接在列的缓冲区上向量化执行。
+# 遍历表或者用下标取出的行只是一个视图，和字典一样可以交给 itemgetter() 使用：
+import operator
+from collections.abc import Mapping
+from itertools import chain, compress
+
+_OPS = {
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    '==': operator.eq, '!=': operator.ne,
+    'in': lambda value, values: value in values,
+    'not in': lambda value, values: value not in values,
+}
+
+
+def _to_array(typecode, values):
+    if np is not None and isinstance(values, np.ndarray):
+        column = array(typecode)
+        column.frombytes(np.ascontiguousarray(values, dtype=typecode).tobytes())
+        return column
+    return array(typecode, values)
+
+
+class _Row(Mapping):
+    __slots__ = ['_table', '_index']
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, name):
+        return self._table._value(name, self._index)
+
+    def __iter__(self):
+        return iter(self._table.columns)
+
+    def __len__(self):
+        return len(self._table.columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Table:
+    def __init__(self, columns, categories=None):
+        self.columns = columns                  # name -> array
+        self.categories = categories or {}      # name -> list of values, for encoded columns
+
+    @classmethod
+    def from_rows(cls, rows, fields=None):
+        '''
+        Build a table from an iterable of dicts. The type of each column is taken
+        from the first row: int, float, or anything else (stored encoded). An int
+        column that later meets a float becomes a float column.
+        '''
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return cls({name: array('q') for name in fields or ()})
+        fields = fields or list(first)
+        columns = {}
+        codes = {}
+        appenders = []
+        for name in fields:
+            value = first[name]
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                columns[name] = array('q' if isinstance(value, int) else 'd')
+                appenders.append([name, columns[name].append])
+            else:
+                columns[name] = array('I')
+                index = codes[name] = {}
+                appenders.append([name, lambda value, append=columns[name].append, index=index:
+                                  append(index.setdefault(value, len(index)))])
+        for row in chain([first], rows):
+            for appender in appenders:
+                name, append = appender
+                value = row[name]
+                try:
+                    append(value)
+                except TypeError:
+                    if columns[name].typecode != 'q' or not isinstance(value, float):
+                        raise
+                    columns[name] = array('d', columns[name])
+                    appender[1] = columns[name].append
+                    appender[1](value)
+        return cls(columns, {name: list(index) for name, index in codes.items()})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), ()))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Table index out of range')
+        return _Row(self, index)
+
+    def __iter__(self):
+        return (_Row(self, index) for index in range(len(self)))
+
+    def __repr__(self):
+        return 'Table({} rows, columns={})'.format(len(self), list(self.columns))
+
+    def _value(self, name, index):
+        value = self.columns[name][index]
+        if name in self.categories:
+            value = self.categories[name][value]
+        return value
+
+    def column(self, name):
+        if name in self.categories:
+            return list(map(self.categories[name].__getitem__, self.columns[name]))
+        return list(self.columns[name])
+
+    def _ranks(self, name):
+        # Renumber the codes of an encoded column so that they sort like the values
+        values = self.categories[name]
+        ranks = array('I', bytes(4 * len(values)))
+        for rank, code in enumerate(sorted(range(len(values)), key=values.__getitem__)):
+            ranks[code] = rank
+        return ranks
+
+    def _unrank(self, name):
+        # Inverse of _ranks(): the code of the value with each rank
+        ranks = self._ranks(name)
+        codes = array('I', bytes(4 * len(ranks)))
+        for code, rank in enumerate(ranks):
+            codes[rank] = code
+        return codes
+
+    def _sort_key(self, name):
+        column = self.columns[name]
+        if np is not None:
+            column = np.frombuffer(column, dtype=column.typecode)
+            if name in self.categories:
+                column = np.frombuffer(self._ranks(name), dtype='I')[column]
+            return column
+        if name in self.categories:
+            return list(map(self._ranks(name).__getitem__, column))
+        return column
+
+    def take(self, indices):
+        '''
+        New table made of the rows at the given indices, in that order
+        '''
+        if np is not None:
+            indices = np.asarray(indices, dtype=np.intp)
+            columns = {name: _to_array(column.typecode, np.frombuffer(column, dtype=column.typecode)[indices])
+                       for name, column in self.columns.items()}
+        else:
+            columns = {name: array(column.typecode, map(column.__getitem__, indices))
+                       for name, column in self.columns.items()}
+        return Table(columns, self.categories)
+
+    def where(self, name, op, value):
+        '''
+        Rows for which "row[name] op value" is true, e.g. where('price', '>', 200)
+        '''
+        test = _OPS[op]
+        column = self.columns[name]
+        if name in self.categories:
+            # Only the distinct values need to be tested
+            match = bytes(test(v, value) for v in self.categories[name])
+            if np is not None:
+                mask = np.frombuffer(match, dtype=np.bool_)[np.frombuffer(column, dtype='I')]
+            else:
+                mask = map(match.__getitem__, column)
+        elif np is not None:
+            column = np.frombuffer(column, dtype=column.typecode)
+            if op in ('in', 'not in'):
+                mask = np.isin(column, list(value), invert=(op == 'not in'))
+            else:
+                mask = test(column, value)
+        else:
+            mask = (test(v, value) for v in column)
+        if np is not None:
+            return self.take(np.flatnonzero(mask))
+        return self.take(list(compress(range(len(column)), mask)))
+
+    def sort_by(self, *names, reverse=False):
+        '''
+        Stable sort on one or more columns, like sorted(rows, key=itemgetter(*names))
+        '''
+        keys = [self._sort_key(name) for name in names]
+        n = len(self)
+        if np is not None:
+            if reverse:
+                # Sort the reversed rows ascending and reverse the result, so that
+                # equal rows keep their original order as with sorted(reverse=True)
+                order = np.lexsort([key[::-1] for key in reversed(keys)])
+                order = (n - 1 - order)[::-1]
+            else:
+                order = np.lexsort(keys[::-1])
+        else:
+            # One stable sort per key, starting from the least significant one
+            order = list(range(n))
+            for key in reversed(keys):
+                order.sort(key=key.__getitem__, reverse=reverse)
+        return self.take(order)
+
+    def group_by(self, name, **aggregates):
+        '''
+        One row per distinct value of name, in sorted order, with aggregate
+        columns given as output=(column, func). func is one of count, sum, min,
+        max or mean. For example: group_by('date', n=('address', 'count'))
+        min and max of an encoded column compare its values; sum and mean need
+        a numeric column.
+        '''
+        for output, (source, func) in aggregates.items():
+            if func not in ('count', 'sum', 'min', 'max', 'mean'):
+                raise ValueError('Unknown aggregate: {!r}'.format(func))
+            if func in ('sum', 'mean') and source in self.categories:
+                raise TypeError('{} needs a numeric column, not {!r}'.format(func, source))
+        categories = {}
+        encoded = name in self.categories
+        if np is not None and len(self):
+            if encoded:
+                ids = self._sort_key(name)
+            else:
+                uniq, ids = np.unique(np.frombuffer(self.columns[name], dtype=self.columns[name].typecode),
+                                      return_inverse=True)
+            order = np.argsort(ids, kind='stable')
+            ids = ids[order]
+            starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+            counts = np.diff(np.append(starts, len(ids)))
+            groups = ids[starts]
+            if encoded:
+                ranks = np.frombuffer(self._ranks(name), dtype='I')
+                keys = np.argsort(ranks)[groups]
+            else:
+                keys = uniq[groups]
+            columns = {name: _to_array(self.columns[name].typecode, keys)}
+            for output, (source, func) in aggregates.items():
+                values = np.frombuffer(self.columns[source], dtype=self.columns[source].typecode)[order]
+                if func == 'count':
+                    columns[output] = _to_array('q', counts)
+                elif func == 'mean':
+                    columns[output] = _to_array('d', np.add.reduceat(values, starts) / counts)
+                elif source in self.categories:
+                    # Reduce the ranks, then turn the winning ranks back into codes
+                    ufunc = np.minimum if func == 'min' else np.maximum
+                    ranks = ufunc.reduceat(self._sort_key(source)[order], starts)
+                    columns[output] = _to_array('I', np.frombuffer(self._unrank(source), dtype='I')[ranks])
+                    categories[output] = self.categories[source]
+                else:
+                    ufunc = {'sum': np.add, 'min': np.minimum, 'max': np.maximum}[func]
+                    columns[output] = _to_array(self.columns[source].typecode, ufunc.reduceat(values, starts))
+        else:
+            groups = {}
+            for index, key in enumerate(self.columns[name]):
+                groups.setdefault(key, []).append(index)
+            if encoded:
+                ranks = self._ranks(name)
+                keys = sorted(groups, key=ranks.__getitem__)
+            else:
+                keys = sorted(groups)
+            columns = {name: array(self.columns[name].typecode, keys)}
+            for output, (source, func) in aggregates.items():
+                column = self.columns[source]
+                if func == 'count':
+                    columns[output] = array('q', (len(groups[key]) for key in keys))
+                elif func == 'mean':
+                    columns[output] = array('d', (sum(map(column.__getitem__, groups[key])) / len(groups[key])
+                                                  for key in keys))
+                elif source in self.categories:
+                    reduce = min if func == 'min' else max
+                    ranks = self._ranks(source)
+                    codes = self._unrank(source)
+                    columns[output] = array('I', (codes[reduce(ranks[column[index]] for index in groups[key])]
+                                                  for key in keys))
+                    categories[output] = self.categories[source]
+                else:
+                    reduce = {'sum': sum, 'min': min, 'max': max}[func]
+                    columns[output] = array(column.typecode, (reduce(map(column.__getitem__, groups[key]))
+                                                              for key in keys))
+        if encoded:
+            categories[name] = self.categories[name]
+        return Table(columns, categories)
+
+
+stocks = Table.from_rows({'name': key, 'price': value} for key, value in prices.items())
+print([row['name'] for row in stocks.where('price', '>', 200)])
+print([row['name'] for row in stocks.where('name', 'in', tech_names)])
+print(stocks.sort_by('price', reverse=True)[0])
+print(list(Table.from_rows(rows).group_by('date', n=('date', 'count'))))
+
+
+def bench_table(nrows=10000000):
+    '''
+    Memory and speed of a Table against a list of dicts, on the 1.13/1.15/1.17 operations
+    '''
+    fnames = ['Brian', 'David', 'John', 'Big', 'Guido', 'Raymond', 'Alex', 'Ned']
+    lnames = ['Jones', 'Beazley', 'Cleese', 'van Rossum', 'Hettinger', 'Martelli']
+    dates = ['07/{:02d}/2012'.format(day) for day in range(1, 32)]
+
+    def gen_rows():
+        for uid in range(nrows):
+            yield {'fname': random.choice(fnames), 'lname': random.choice(lnames), 'uid': uid,
+                   'date': random.choice(dates), 'price': random.random() * 1000}
+
+    def build(make):
+        random.seed(0)
+        tracemalloc.start()
+        start = time.perf_counter()
+        data = make()
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return data, elapsed, size
+
+    def timed(func):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+    dicts, dict_build, dict_size = build(lambda: list(gen_rows()))
+    dict_times = [
+        timed(lambda: sorted(dicts, key=itemgetter('lname', 'fname'))),
+        timed(lambda: [row for row in dicts if row['price'] > 200]),
+        timed(lambda: [row for row in dicts if row['lname'] in {'Jones', 'Cleese'}]),
+        timed(lambda: [(date, sum(row['price'] for row in items))
+                       for date, items in groupby(sorted(dicts, key=itemgetter('date')), key=itemgetter('date'))]),
+    ]
+    del dicts
+    table, table_build, table_size = build(lambda: Table.from_rows(gen_rows()))
+    table_times = [
+        timed(lambda: table.sort_by('lname', 'fname')),
+        timed(lambda: table.where('price', '>', 200)),
+        timed(lambda: table.where('lname', 'in', {'Jones', 'Cleese'})),
+        timed(lambda: table.group_by('date', total=('price', 'sum'))),
+    ]
+    print('{} rows{}'.format(nrows, '' if np is not None else ' (without NumPy)'))
+    print('{:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        '', 'MB', 'build', 'sort', 'filter', 'in', 'group'))
+    for label, size, build_time, times in [('dicts', dict_size, dict_build, dict_times),
+                                           ('Table', table_size, table_build, table_times)]:
+        print('{:>10} {:>10.1f} {:>9.2f}s {}'.format(label, size / 2**20, build_time,
+                                                   ' '.join('{:>9.2f}s'.format(t) for t in times)))
+
 # 1.18 映射名称到序列元素
 # 你有一段通过下标访问列表或者元组中元素的代码，但是这样有时候会使得你的代码难以阅读，
 # 于是你想通过名称来访问元素。
@@ -268,6 +1591,226 @@ Subscriber = namedtuple('Subscriber', ['addr', 'joined'])
 sub = Subscriber('jonesy@example.com', '2012-10-19')
 print(sub.addr, sub.joined)
 
+# 每条记录都是一个 namedtuple 时，一百万条记录就是一百万个元组再加上其中的字符串对象。
+# RecordBatch 按 namedtuple 的字段把记录存进连续的列里：数值存成 array，字符串按 UTF-8 拼接到一个 bytearray 中
+# 并记下偏移量，取值很少的字符串(比如日期)则用整数编码。下标访问得到的是一个轻量的视图，按属性名读取时才解码。
+# from_csv() 可以直接从 csv.reader() 读出的行构造，to_records() 再转换回 namedtuple 列表：
+import csv
+import io
+
+
+class _RecordView:
+    __slots__ = ['_batch', '_index']
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    def __iter__(self):
+        return (self._batch._value(name, self._index) for name in self._batch.schema._fields)
+
+    def __len__(self):
+        return len(self._batch.schema._fields)
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def _asrecord(self):
+        return self._batch.schema._make(self)
+
+    def __repr__(self):
+        return repr(self._asrecord())
+
+
+def _view_field(name):
+    return property(lambda self: self._batch._getters[name](self._index))
+
+
+class RecordBatch:
+    def __init__(self, schema, types):
+        '''
+        types maps each field of the namedtuple schema to an array typecode,
+        'str' (packed UTF-8) or 'category' (encoded, for few distinct values)
+        '''
+        self.schema = schema
+        self.types = types
+        self._columns = {}
+        self._appenders = []
+        self._poppers = []
+        self._getters = {}
+        for name in schema._fields:
+            kind = types[name]
+            if kind == 'str':
+                data, offsets = self._columns[name] = (bytearray(), array('Q', [0]))
+
+                def append(value, data=data, offsets=offsets):
+                    data += value.encode('utf-8')
+                    offsets.append(len(data))
+
+                def get(index, data=data, offsets=offsets):
+                    return data[offsets[index]:offsets[index + 1]].decode('utf-8')
+
+                def pop(data=data, offsets=offsets):
+                    offsets.pop()
+                    del data[offsets[-1]:]
+            elif kind == 'category':
+                codes, values, index = self._columns[name] = (array('I'), [], {})
+
+                def append(value, codes=codes, values=values, index=index):
+                    code = index.get(value)
+                    if code is None:
+                        code = index[value] = len(values)
+                        values.append(value)
+                    codes.append(code)
+
+                def get(index, codes=codes, values=values):
+                    return values[codes[index]]
+
+                pop = codes.pop
+            else:
+                self._columns[name] = array(kind)
+                append = self._columns[name].append
+                get = self._columns[name].__getitem__
+                pop = self._columns[name].pop
+            self._appenders.append(append)
+            self._poppers.append(pop)
+            self._getters[name] = get
+        self._view = type(schema.__name__ + 'View', (_RecordView,),
+                          {'__slots__': (), **{name: _view_field(name) for name in schema._fields}})
+
+    @classmethod
+    def from_records(cls, schema, records, types=None):
+        '''
+        Build a batch from namedtuples (or plain tuples). Without types, the type
+        of each field is taken from the first record.
+        '''
+        records = iter(records)
+        first = next(records, None)
+        if types is None:
+            if first is None:
+                raise ValueError('types are required to build an empty batch')
+            types = {}
+            for name, value in zip(schema._fields, first):
+                if isinstance(value, float):
+                    types[name] = 'd'
+                elif isinstance(value, int):
+                    types[name] = 'q'
+                else:
+                    types[name] = 'str'
+        batch = cls(schema, types)
+        if first is not None:
+            batch.extend(chain([first], records))
+        return batch
+
+    @classmethod
+    def from_csv(cls, schema, rows, types):
+        '''
+        Build a batch from rows of strings, e.g. those produced by csv.reader()
+        '''
+        batch = cls(schema, types)
+        convert = [float if types[name] in 'fd' else int if types[name] not in ('str', 'category') else None
+                   for name in schema._fields]
+        for row in rows:
+            if len(row) != len(convert):
+                raise ValueError('Expected {} fields, got {}: {!r}'.format(len(convert), len(row), row))
+            # Convert the whole row first; _append() rolls back values a column rejects
+            batch._append([func(value) if func else value for func, value in zip(convert, row)])
+        return batch
+
+    def _append(self, record):
+        if len(record) != len(self._appenders):
+            raise ValueError('Expected {} fields, got {}: {!r}'.format(len(self._appenders), len(record), record))
+        done = 0
+        try:
+            for append, value in zip(self._appenders, record):
+                append(value)
+                done += 1
+        except BaseException:
+            # A bad value (wrong type, too big for its typecode) must not leave the columns uneven
+            for pop in self._poppers[:done]:
+                pop()
+            raise
+
+    def append(self, record):
+        self._append(tuple(record))
+
+    def extend(self, records):
+        for record in records:
+            self._append(tuple(record))
+
+    def __len__(self):
+        column = self._columns[self.schema._fields[0]]
+        kind = self.types[self.schema._fields[0]]
+        if kind == 'str':
+            return len(column[1]) - 1
+        return len(column[0] if kind == 'category' else column)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('RecordBatch index out of range')
+        return self._view(self, index)
+
+    def __iter__(self):
+        view = self._view
+        return (view(self, index) for index in range(len(self)))
+
+    def _value(self, name, index):
+        return self._getters[name](index)
+
+    def column(self, name):
+        kind = self.types[name]
+        if kind == 'str':
+            data, offsets = self._columns[name]
+            return [data[start:stop].decode('utf-8') for start, stop in zip(offsets, offsets[1:])]
+        if kind == 'category':
+            codes, values, index = self._columns[name]
+            return list(map(values.__getitem__, codes))
+        return list(self._columns[name])
+
+    def to_records(self):
+        return list(map(self.schema._make, zip(*[self.column(name) for name in self.schema._fields])))
+
+
+subs = RecordBatch.from_csv(Subscriber, csv.reader(io.StringIO(
+    'jonesy@example.com,2012-10-19\n'
+    'dave@example.com,2012-10-19\n')), {'addr': 'str', 'joined': 'category'})
+print(subs[1].addr, subs[1].joined)
+print(subs.to_records())
+
+
+def bench_record_batch(nrecords=1000000):
+    '''
+    Memory and build time of a list of namedtuples against a RecordBatch, from CSV
+    '''
+    Trade = namedtuple('Trade', ['addr', 'joined', 'shares', 'price'])
+    text = io.StringIO()
+    writer = csv.writer(text)
+    for n in range(nrecords):
+        writer.writerow(['user{}@example.com'.format(n), '2012-10-{:02d}'.format(random.randint(1, 31)),
+                         random.randint(1, 1000), round(random.random() * 1000, 2)])
+    types = {'addr': 'str', 'joined': 'category', 'shares': 'i', 'price': 'd'}
+
+    def build_tuples(rows):
+        return [Trade(addr, joined, int(shares), float(price)) for addr, joined, shares, price in rows]
+
+    for label, build in [('namedtuples', build_tuples),
+                         ('RecordBatch', lambda rows: RecordBatch.from_csv(Trade, rows, types))]:
+        text.seek(0)
+        tracemalloc.start()
+        start = time.perf_counter()
+        records = build(csv.reader(text))
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        total = sum(record.price * record.shares for record in records)
+        scan = time.perf_counter() - start
+        print('{:>12}: {:8.1f} MB ({:5.1f} bytes/record), build {:.2f}s, scan {:.2f}s'.format(
+            label, size / 2**20, size / nrecords, elapsed, scan))
+        del records
+
 # 1.19 转换并同时计算数据
 # 你需要在数据序列上执行聚集函数（比如 sum() , min() , max() ）， 但是首先你需要先转换或者过滤数据
 nums = [1, 2, 3, 4, 5]
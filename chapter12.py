@@ -69,6 +69,230 @@ t2 = Thread(target=producer, args=(q,))
 t1.start()
 t2.start()
 
+# 上面的 Queue 是无界的，生产者比消费者快的时候队列会无限增长；而且每个元素都要单独 get() 一次。
+# 下面把它扩展成一个可以复用的流水线：每一级都有一个有界队列，按批次 put_many()/get_many()，
+# 每一级可以有多个消费者线程，用一个哨兵对象来通知关闭，并统计每一级的队列深度和吞吐量，
+# 这样就能找出多级流水线中最慢的那一级。
+# 如果某一级出错或者调用者提前停止迭代 run()，run() 会关闭所有队列，
+# 阻塞在满队列或空队列上的线程都会收到 QueueClosed 异常并退出，而不是永远等下去：
+import threading
+from collections import deque
+
+# Sentinel put on a queue to shut the consumers down
+_STOP = object()
+
+class _Failure:
+    '''
+    An exception raised in a stage, on its way to Pipeline.run()
+    '''
+    def __init__(self, exc):
+        self.exc = exc
+
+class QueueClosed(Exception):
+    pass
+
+class BatchQueue:
+    '''
+    A bounded queue that moves items in batches to reduce locking overhead
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def qsize(self):
+        '''
+        Number of queued items, not counting a shutdown sentinel
+        '''
+        with self._lock:
+            n = len(self._items)
+            if n and self._items[-1] is _STOP:
+                n -= 1
+            return n
+
+    def close(self):
+        '''
+        Discard the queued items and make every blocked or later
+        put_many()/get_many() raise QueueClosed
+        '''
+        with self._lock:
+            self._closed = True
+            self._items.clear()
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def put_many(self, items):
+        '''
+        Put all of the items, blocking while the queue is full
+        '''
+        items = list(items)
+        while items:
+            with self._not_full:
+                while len(self._items) >= self.maxsize and not self._closed:
+                    self._not_full.wait()
+                if self._closed:
+                    raise QueueClosed()
+                space = self.maxsize - len(self._items)
+                self._items.extend(items[:space])
+                del items[:space]
+                self._not_empty.notify_all()
+
+    def put(self, item):
+        self.put_many([item])
+
+    def get_many(self, maxitems=64):
+        '''
+        Get between 1 and maxitems items, blocking while the queue is empty
+        '''
+        with self._not_empty:
+            while not self._items and not self._closed:
+                self._not_empty.wait()
+            if self._closed:
+                raise QueueClosed()
+            n = min(maxitems, len(self._items))
+            batch = [self._items.popleft() for _ in range(n)]
+            self._not_full.notify_all()
+            return batch
+
+class Stage:
+    '''
+    A pipeline stage that applies func to each item using nworkers consumer
+    threads. Results of None are dropped.
+    '''
+    def __init__(self, name, func, nworkers=1, maxsize=1024, batchsize=64):
+        self.name = name
+        self.func = func
+        self.nworkers = nworkers
+        self.batchsize = batchsize
+        self.inq = BatchQueue(maxsize)
+        self.outq = None
+        self.errq = None
+        self.processed = 0
+        self.busy = 0.0
+        self._running = 0
+        self._lock = threading.Lock()
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._running = self.nworkers
+        for n in range(self.nworkers):
+            Thread(target=self._consumer, daemon=True).start()
+
+    def _consumer(self):
+        try:
+            self._consume()
+        except QueueClosed:
+            # The pipeline was shut down early
+            pass
+
+    def _consume(self):
+        while True:
+            batch = self.inq.get_many(self.batchsize)
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+                # Leave the sentinel for the other consumers of this stage
+                self.inq.put(_STOP)
+            start = time.perf_counter()
+            try:
+                results = [result for result in map(self.func, batch) if result is not None]
+            except Exception as e:
+                # Report the error and retire this worker, so the pipeline can't hang on it
+                if self.errq is not None:
+                    self.errq.put(_Failure(e))
+                results = []
+                stopping = True
+            elapsed = time.perf_counter() - start
+            if self.outq is not None and results:
+                self.outq.put_many(results)
+            with self._lock:
+                self.processed += len(batch)
+                self.busy += elapsed
+                if stopping:
+                    self._running -= 1
+                    last = self._running == 0
+            if stopping:
+                # The last consumer to finish passes the sentinel downstream
+                if last and self.outq is not None:
+                    self.outq.put(_STOP)
+                return
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        return {'stage': self.name,
+                'depth': self.inq.qsize(),
+                'processed': self.processed,
+                'throughput': self.processed / elapsed if elapsed else 0.0,
+                'busy': self.busy}
+
+class Pipeline:
+    '''
+    Connect stages together so that the output of one feeds the next
+    '''
+    def __init__(self, *stages, maxsize=1024):
+        self.stages = stages
+        self.output = BatchQueue(maxsize)
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.outq = next_stage.inq
+        stages[-1].outq = self.output
+        for stage in stages:
+            stage.errq = self.output
+
+    def _feed(self, items, batchsize):
+        batch = []
+        try:
+            for item in items:
+                batch.append(item)
+                if len(batch) >= batchsize:
+                    self.stages[0].inq.put_many(batch)
+                    batch = []
+            batch.append(_STOP)
+            self.stages[0].inq.put_many(batch)
+        except QueueClosed:
+            # Stop consuming items once the pipeline is shut down
+            pass
+
+    def close(self):
+        '''
+        Shut the pipeline down, releasing every thread blocked on one of its queues
+        '''
+        for stage in self.stages:
+            stage.inq.close()
+        self.output.close()
+
+    def run(self, items, batchsize=64):
+        '''
+        Push items through every stage, yielding the results of the last one.
+        An exception raised by a stage function is re-raised here. The pipeline
+        is closed when run() finishes, fails, or is abandoned by the caller.
+        '''
+        for stage in self.stages:
+            stage.start()
+        Thread(target=self._feed, args=(items, batchsize), daemon=True).start()
+        try:
+            while True:
+                for result in self.output.get_many(batchsize):
+                    if result is _STOP:
+                        return
+                    if isinstance(result, _Failure):
+                        raise result.exc
+                    yield result
+        finally:
+            self.close()
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+# 例如：
+# p = Pipeline(Stage('parse', int, nworkers=2), Stage('square', lambda x: x * x, nworkers=4))
+# total = sum(p.run(str(n) for n in range(100000)))
+# for s in p.stats():
+#     print(s)
+
 # 12.4 给关键部分加锁
 import threading
 
@@ -93,6 +317,136 @@ class SharedCounter:
         '''
         with self._value_lock:
              self._value -= delta
+
+# SharedCounter 的每次 incr()/decr() 都要获取同一把锁，线程一多大家就都在排队。
+# 可以把计数器分片：每个线程只修改属于自己的分片，读取的时候再把所有分片加起来。
+# 分片只有它自己的线程会写，所以 incr() 完全不用加锁；分片里的 seq 在修改期间为奇数，
+# snapshot() 前后两次读取 seq，没有变化才说明读到的各个分片值在同一时刻是成立的（seqlock）。
+# 线程退出后，它的分片会被合并回基础值，所以频繁创建线程时分片也不会越积越多：
+import weakref
+
+class _CounterShard:
+    __slots__ = ['value', 'seq']
+
+    def __init__(self):
+        self.value = 0
+        self.seq = 0
+
+class _ThreadToken:
+    '''
+    Kept only in a thread's local storage, so it is freed when the thread exits
+    '''
+    __slots__ = ['__weakref__']
+
+class ShardedCounter:
+    '''
+    A counter object that can be shared by multiple threads without
+    serializing them on a single lock.
+    '''
+    def __init__(self, initial_value = 0):
+        self._initial_value = initial_value
+        self._shards = set()
+        self._shards_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _CounterShard()
+            token = self._local.token = _ThreadToken()
+            weakref.finalize(token, ShardedCounter._retire, weakref.ref(self), shard)
+            with self._shards_lock:
+                self._shards.add(shard)
+            return shard
+
+    @staticmethod
+    def _retire(counter_ref, shard):
+        # The thread that owned shard has exited: fold its count into the base value
+        counter = counter_ref()
+        if counter is None:
+            return
+        with counter._shards_lock:
+            counter._initial_value += shard.value
+            counter._shards.discard(shard)
+
+    def incr(self,delta=1):
+        '''
+        Increment this thread's shard of the counter (only this thread writes it,
+        so no lock is needed)
+        '''
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        # seq is odd while the update is in progress
+        shard.seq += 1
+        shard.value += delta
+        shard.seq += 1
+
+    def decr(self,delta=1):
+        '''
+        Decrement this thread's shard of the counter
+        '''
+        self.incr(-delta)
+
+    def incr_many(self, deltas):
+        '''
+        Accumulate a batch of increments locally and publish them to this
+        thread's shard with a single update
+        '''
+        total = 0
+        for delta in deltas:
+            total += delta
+        self.incr(total)
+
+    @property
+    def value(self):
+        '''
+        Sum the shards without locking (may miss updates that are in progress)
+        '''
+        with self._shards_lock:
+            shards = list(self._shards)
+            base = self._initial_value
+        return base + sum(shard.value for shard in shards)
+
+    def snapshot(self):
+        '''
+        Return a consistent value: the total at some instant during the call.
+        Retries until no shard changes while the shards are being read.
+        '''
+        with self._shards_lock:
+            shards = list(self._shards)
+            base = self._initial_value
+        # A retired shard stays in our list with its final value, and base still
+        # lacks it, so shards exiting during the read don't matter
+        while True:
+            before = [shard.seq for shard in shards]
+            values = [shard.value for shard in shards]
+            after = [shard.seq for shard in shards]
+            if before == after and not any(seq & 1 for seq in before):
+                return base + sum(values)
+            time.sleep(0)
+
+# 下面的基准测试比较两种计数器在 1 到 64 个线程下的吞吐量：
+def bench_counters(nops=100000, maxthreads=64):
+    nthreads = 1
+    while nthreads <= maxthreads:
+        for cls in (SharedCounter, ShardedCounter):
+            counter = cls()
+            def work():
+                for n in range(nops // nthreads):
+                    counter.incr()
+            threads = [Thread(target=work) for n in range(nthreads)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            print('{:>14} {:>2} threads: {:.0f} incr/s'.format(
+                cls.__name__, nthreads, nops // nthreads * nthreads / elapsed))
+        nthreads *= 2
 # 12.5 防止死锁的加锁机制
 import threading
 from contextlib import contextmanager
@@ -124,6 +478,133 @@ def acquire(*locks):
             lock.release()
         del acquired[-len(locks):]
 
+# 上面的 acquire() 用 id() 给锁排序，而 id() 在每次运行时都不一样，出了问题很难复现。
+# 而且它也看不出时间都花在哪里了。下面的版本要求先把锁注册到 LockRegistry 中以确定一个稳定的顺序，
+# 支持超时(超时后会释放已经获取的锁)，并用按2的幂分桶的直方图记录每组锁的等待时间和持有时间：
+from collections import defaultdict
+
+NBUCKETS = 32
+
+def _bucket(seconds):
+    # Bucket n holds times in [2**(n-1), 2**n) microseconds
+    return min(int(seconds * 1e6).bit_length(), NBUCKETS - 1)
+
+class LockStats:
+    __slots__ = ['count', 'timeouts', 'wait', 'hold', 'wait_hist', 'hold_hist']
+
+    def __init__(self):
+        self.count = self.timeouts = 0
+        self.wait = self.hold = 0.0
+        self.wait_hist = [0] * NBUCKETS
+        self.hold_hist = [0] * NBUCKETS
+
+class LockRegistry:
+    '''
+    Acquire multiple locks in a stable registered order, with timeouts
+    and wait/hold time histograms for each set of locks.
+    '''
+    def __init__(self):
+        self._ranks = {}
+        self._names = {}
+        self._stats = defaultdict(LockStats)
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    def register(self, lock, name, rank=None):
+        '''
+        Register a lock under a name. Locks are always acquired in increasing
+        rank, which defaults to one more than the highest rank so far. Ranks
+        must be unique, so that the acquisition order is a total order.
+        '''
+        if lock in self._ranks:
+            raise ValueError('Lock {!r} is already registered as {}'.format(lock, self._names[lock]))
+        if rank is None:
+            rank = max(self._ranks.values(), default=-1) + 1
+        elif rank in self._ranks.values():
+            raise ValueError('Rank {} is already in use'.format(rank))
+        self._ranks[lock] = rank
+        self._names[lock] = name
+        return lock
+
+    def _rank(self, lock):
+        try:
+            return self._ranks[lock]
+        except KeyError:
+            raise RuntimeError('Lock {!r} is not registered'.format(lock)) from None
+
+    @contextmanager
+    def acquire(self, *locks, timeout=-1):
+        locks = sorted(locks, key=self._rank)
+        key = tuple(self._names[lock] for lock in locks)
+
+        # Make sure lock order of previously acquired locks is not violated
+        acquired = getattr(self._local, 'acquired', [])
+        if acquired and max(self._rank(lock) for lock in acquired) >= self._rank(locks[0]):
+            raise RuntimeError('Lock Order Violation')
+
+        start = time.perf_counter()
+        deadline = start + timeout
+        held = []
+        try:
+            for lock in locks:
+                remaining = -1 if timeout < 0 else max(deadline - time.perf_counter(), 0)
+                if not lock.acquire(timeout=remaining):
+                    # A timed out attempt waited too, and is counted in the wait statistics
+                    wait = time.perf_counter() - start
+                    with self._stats_lock:
+                        stats = self._stats[key]
+                        stats.timeouts += 1
+                        stats.wait += wait
+                        stats.wait_hist[_bucket(wait)] += 1
+                    raise TimeoutError('Timed out acquiring {}'.format(self._names[lock]))
+                held.append(lock)
+            acquired.extend(locks)
+            self._local.acquired = acquired
+            got = time.perf_counter()
+            try:
+                yield
+            finally:
+                del acquired[-len(locks):]
+                self._record(key, got - start, time.perf_counter() - got)
+        finally:
+            # Release locks in reverse order of acquisition (rolls back on a timeout)
+            for lock in reversed(held):
+                lock.release()
+
+    def _record(self, key, wait, hold):
+        with self._stats_lock:
+            stats = self._stats[key]
+            stats.count += 1
+            stats.wait += wait
+            stats.hold += hold
+            stats.wait_hist[_bucket(wait)] += 1
+            stats.hold_hist[_bucket(hold)] += 1
+
+    def dump(self, n=10):
+        '''
+        Return the n lock sets with the most total wait time
+        '''
+        with self._stats_lock:
+            items = [(key, stats) for key, stats in self._stats.items()]
+            items.sort(key=lambda item: item[1].wait, reverse=True)
+            return [{'locks': key,
+                     'count': stats.count,
+                     'timeouts': stats.timeouts,
+                     'wait': stats.wait,
+                     'hold': stats.hold,
+                     'wait_hist': list(stats.wait_hist),
+                     'hold_hist': list(stats.hold_hist)}
+                    for key, stats in items[:n]]
+
+# 使用方法如下：
+# registry = LockRegistry()
+# x_lock = registry.register(threading.Lock(), 'x')
+# y_lock = registry.register(threading.Lock(), 'y')
+# with registry.acquire(y_lock, x_lock, timeout=1.0):
+#     ...
+# for row in registry.dump():
+#     print(row['locks'], row['count'], row['wait'], row['hold'])
+
 # 12.6 保存线程的状态信息
 from socket import socket, AF_INET, SOCK_STREAM
 import threading
@@ -146,6 +627,162 @@ class LazyConnection:
         self.local.sock.close()
         del self.local.sock
 
+# LazyConnection 每次进入 with 语句都要新建一个连接，退出时再关闭，TCP握手的代价可能比请求本身还大。
+# 下面的连接池按地址缓存空闲连接，限制每个地址的最大连接数，丢弃空闲太久或者已经断开的连接，
+# 并且优先把线程上次用过的连接还给同一个线程。PooledConnection 的用法和 LazyConnection 完全一样：
+from collections import defaultdict
+from socket import MSG_PEEK
+
+class ConnectionPool:
+    '''
+    A bounded pool of reusable socket connections keyed by address
+    '''
+    def __init__(self, maxsize=8, idle_timeout=60.0, family=AF_INET, type=SOCK_STREAM):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.family = family
+        self.type = type
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._idle = defaultdict(list)      # address -> [(sock, last_used)]
+        self._open = defaultdict(int)       # address -> number of open sockets
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    @staticmethod
+    def _healthy(sock):
+        '''
+        A pooled connection is healthy if the peer has not closed it and sent nothing unexpected
+        '''
+        sock.setblocking(False)
+        try:
+            sock.recv(1, MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.setblocking(True)
+
+    def _take_idle(self, address):
+        idle = self._idle[address]
+        last = getattr(self._local, 'last', {}).get(address)
+        for n, (sock, last_used) in enumerate(idle):
+            if sock is last:
+                return idle.pop(n)
+        return idle.pop()
+
+    def _discard(self, address, sock):
+        sock.close()
+        with self._cond:
+            self._open[address] -= 1
+            self._cond.notify()
+
+    def checkout(self, address, timeout=None):
+        '''
+        Get a connection to address, waiting up to timeout seconds if the pool is full
+        '''
+        start = time.perf_counter()
+        waited = False
+        while True:
+            with self._cond:
+                while not self._idle[address] and self._open[address] >= self.maxsize:
+                    waited = True
+                    remaining = None if timeout is None else timeout - (time.perf_counter() - start)
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError('No connection to {} available'.format(address))
+                    self._cond.wait(remaining)
+                if waited:
+                    self.waits += 1
+                    self.wait_time += time.perf_counter() - start
+                    waited = False
+                if self._idle[address]:
+                    sock, last_used = self._take_idle(address)
+                else:
+                    self._open[address] += 1
+                    self.misses += 1
+                    sock = None
+            if sock is None:
+                break
+            if time.monotonic() - last_used > self.idle_timeout or not self._healthy(sock):
+                self._discard(address, sock)
+                continue
+            with self._cond:
+                self.hits += 1
+            return sock
+
+        sock = socket(self.family, self.type)
+        try:
+            sock.connect(address)
+        except OSError:
+            self._discard(address, sock)
+            raise
+        return sock
+
+    def checkin(self, address, sock, broken=False):
+        '''
+        Return a connection to the pool (closing it if it is broken)
+        '''
+        if broken:
+            self._discard(address, sock)
+            return
+        if not hasattr(self._local, 'last'):
+            self._local.last = {}
+        self._local.last[address] = sock
+        with self._cond:
+            self._idle[address].append((sock, time.monotonic()))
+            self._cond.notify()
+
+    def connection(self, address):
+        return PooledConnection(self, address)
+
+    def stats(self):
+        with self._cond:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'waits': self.waits, 'wait_time': self.wait_time,
+                    'open': dict(self._open),
+                    'idle': {address: len(idle) for address, idle in self._idle.items()}}
+
+    def close(self):
+        with self._cond:
+            for address, idle in self._idle.items():
+                for sock, last_used in idle:
+                    sock.close()
+                self._open[address] -= len(idle)
+                idle.clear()
+
+class PooledConnection:
+    def __init__(self, pool, address):
+        self.pool = pool
+        self.address = address
+        self.local = threading.local()
+
+    def __enter__(self):
+        if hasattr(self.local, 'sock'):
+            raise RuntimeError('Already connected')
+        self.local.sock = self.pool.checkout(self.address)
+        return self.local.sock
+
+    def __exit__(self, exc_ty, exc_val, tb):
+        # A connection that saw an exception may be in an unknown state
+        self.pool.checkin(self.address, self.local.sock, broken=exc_ty is not None)
+        del self.local.sock
+
+# 例如，可以对着本地的 echo 服务器测试：
+# pool = ConnectionPool(maxsize=4)
+# conn = pool.connection(('localhost', 15000))
+# def test(conn):
+#     for n in range(10):
+#         with conn as s:
+#             s.sendall(b'hello')
+#             s.recv(5)
+# for n in range(8):
+#     threading.Thread(target=test, args=(conn,)).start()
+# print(pool.stats())
+
 # 12.7 创建一个线程池
 from socket import AF_INET, SOCK_STREAM, socket
 from concurrent.futures import ThreadPoolExecutor
@@ -211,6 +848,341 @@ def echo_server(addr, nworkers):
         q.put((client_sock, client_addr))
 
 echo_server(('',15000), 128)
+
+# 上面两种实现中每个连接都要占用一个线程，128个客户端连上之后就不能再处理新的连接了，
+# 而且每个阻塞的线程都有自己完整的栈。使用 asyncio 的流可以用一个线程处理大量连接。
+# 下面的实现通过 drain() 提供背压，用信号量限制最大连接数，并支持优雅关闭：
+import asyncio
+
+class AsyncEchoServer:
+    '''
+    An asyncio echo server with a connection limit and graceful shutdown
+    '''
+    def __init__(self, addr, max_connections=10000, shutdown_timeout=5.0):
+        self.addr = addr
+        self.max_connections = max_connections
+        self.shutdown_timeout = shutdown_timeout
+        self.started = threading.Event()
+        self._tasks = set()
+        self._loop = None
+        self._stopping = None
+
+    async def _echo_client(self, reader, writer):
+        '''
+        Handle a client connection
+        '''
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            # Connections beyond the limit wait here, just as they would in the thread pool
+            async with self._limit:
+                while True:
+                    msg = await reader.read(65536)
+                    if not msg:
+                        break
+                    writer.write(msg)
+                    # Stop reading until the client has consumed what we sent
+                    await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Cancelled clients were still connected when the shutdown timeout expired
+            pass
+        finally:
+            writer.close()
+            self._tasks.discard(task)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._limit = asyncio.Semaphore(self.max_connections)
+        server = await asyncio.start_server(self._echo_client, *self.addr, backlog=1024)
+        self.started.set()
+        await self._stopping.wait()
+
+        # Stop accepting, give active clients a chance to finish, then cancel the rest
+        server.close()
+        if self._tasks:
+            done, pending = await asyncio.wait(self._tasks, timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+        await server.wait_closed()
+
+    def stop(self):
+        '''
+        Request a graceful shutdown (safe to call from any thread)
+        '''
+        self._loop.call_soon_threadsafe(self._stopping.set)
+
+# AsyncEchoServer(('', 15000)) 可以直接用 asyncio.run(server.serve()) 运行。
+# 下面是一个简单的压测工具，在本机上比较每秒处理的连接数以及 p99 延迟：
+async def _load_client(addr, nmessages, payload, latencies, limit):
+    async with limit:
+        try:
+            reader, writer = await asyncio.open_connection(*addr)
+            for n in range(nmessages):
+                start = time.perf_counter()
+                writer.write(payload)
+                await writer.drain()
+                await reader.readexactly(len(payload))
+                latencies.append(time.perf_counter() - start)
+            writer.close()
+            await writer.wait_closed()
+            return True
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return False
+
+async def load_test(addr, nclients=1000, nmessages=10, size=128, concurrency=200):
+    '''
+    Open nclients connections (at most concurrency at a time) that each echo
+    nmessages of size bytes. Returns completed connections per second, the number
+    of failed connections and the p99 round-trip latency.
+    '''
+    latencies = []
+    limit = asyncio.Semaphore(concurrency)
+    payload = b'x' * size
+    start = time.perf_counter()
+    ok = await asyncio.gather(*(_load_client(addr, nmessages, payload, latencies, limit)
+                                for n in range(nclients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'connections_per_sec': sum(ok) / elapsed,
+        'failed': ok.count(False),
+        'p99_latency_ms': latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000 if latencies else None,
+    }
+
+def echo_client_quiet(sock, client_addr):
+    '''
+    echo_client() without the prints, so that only the echoing is timed
+    '''
+    try:
+        while True:
+            msg = sock.recv(65536)
+            if not msg:
+                break
+            sock.sendall(msg)
+    except ConnectionError:
+        pass
+    finally:
+        sock.close()
+
+def _listen(addr, started):
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.bind(addr)
+    # Same backlog as AsyncEchoServer, so that neither side refuses connections sooner
+    sock.listen(1024)
+    started.set()
+    return sock
+
+def pool_echo_server(addr, started, nworkers=128):
+    '''
+    The ThreadPoolExecutor echo_server() from above
+    '''
+    pool = ThreadPoolExecutor(nworkers)
+    sock = _listen(addr, started)
+    while True:
+        client_sock, client_addr = sock.accept()
+        pool.submit(echo_client_quiet, client_sock, client_addr)
+
+def queue_echo_server(addr, started, nworkers=128):
+    '''
+    The Queue and daemon thread echo_server() from above, with workers that
+    go back to the queue for the next connection
+    '''
+    q = Queue()
+    def worker():
+        while True:
+            echo_client_quiet(*q.get())
+    for n in range(nworkers):
+        Thread(target=worker, daemon=True).start()
+    sock = _listen(addr, started)
+    while True:
+        q.put(sock.accept())
+
+def bench_echo_servers(nclients=1000, nmessages=10, concurrency=200):
+    '''
+    Compare the asyncio server with both thread based echo_server() versions on localhost
+    '''
+    server = AsyncEchoServer(('127.0.0.1', 15001))
+    Thread(target=asyncio.run, args=(server.serve(),), daemon=True).start()
+    server.started.wait()
+    print('asyncio:', asyncio.run(load_test(('127.0.0.1', 15001), nclients, nmessages,
+                                            concurrency=concurrency)))
+    server.stop()
+
+    for name, port, target in [('ThreadPoolExecutor', 15002, pool_echo_server),
+                               ('Queue + threads', 15005, queue_echo_server)]:
+        started = threading.Event()
+        Thread(target=target, args=(('127.0.0.1', port), started), daemon=True).start()
+        started.wait()
+        print('{}:'.format(name), asyncio.run(load_test(('127.0.0.1', port), nclients, nmessages,
+                                                        concurrency=concurrency)))
+
+# echo_client() 中每次 sock.recv(65536) 都会创建一个新的 bytes 对象。连接很多的时候，
+# 内存分配的开销就很可观了。可以从一个缓冲池中取出预先分配好的 bytearray，
+# 用 recv_into() 直接读进去，再通过 memoryview 切片发送，整个过程不会复制数据。
+# 每回显一个字节要额外分配多少内存，是用 tracemalloc 实际测出来的：
+import sys
+import tracemalloc
+from socket import socketpair
+
+class BufferPool:
+    '''
+    A thread-safe pool of reusable bytearray buffers
+    '''
+    def __init__(self, size=65536, maxbuffers=128, stats=None):
+        self.size = size
+        self.maxbuffers = maxbuffers
+        self.stats = stats
+        self._free = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        if self.stats:
+            self.stats.add(0, 1)
+        return bytearray(self.size)
+
+    def put(self, buf):
+        with self._lock:
+            if len(self._free) < self.maxbuffers:
+                self._free.append(buf)
+
+class EchoStats:
+    '''
+    Count the bytes echoed and the buffers the pool had to allocate
+    '''
+    def __init__(self):
+        self.nbytes = 0
+        self.allocations = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, allocations):
+        with self._lock:
+            self.nbytes += nbytes
+            self.allocations += allocations
+
+def echo_client_counted(sock, client_addr, stats):
+    '''
+    Handle a client connection with recv(), counting the bytes echoed
+    '''
+    nbytes = 0
+    try:
+        while True:
+            msg = sock.recv(65536)
+            if not msg:
+                break
+            sock.sendall(msg)
+            nbytes += len(msg)
+    finally:
+        sock.close()
+        stats.add(nbytes, 0)
+
+def echo_client_pooled(sock, client_addr, pool, stats):
+    '''
+    Handle a client connection using recv_into() on a pooled buffer
+    '''
+    buf = pool.get()
+    nbytes = 0
+    with memoryview(buf) as view:
+        try:
+            while True:
+                n = sock.recv_into(buf)
+                if not n:
+                    break
+                sock.sendall(view[:n])
+                nbytes += n
+        finally:
+            sock.close()
+            pool.put(buf)
+            stats.add(nbytes, 0)
+
+class AllocationProbe:
+    '''
+    Wrap a socket and measure with tracemalloc how much memory each read allocates
+    '''
+    def __init__(self, sock):
+        self._sock = sock
+        self.allocated = 0
+
+    def recv(self, bufsize):
+        before = tracemalloc.get_traced_memory()[0]
+        msg = self._sock.recv(bufsize)
+        self.allocated += tracemalloc.get_traced_memory()[0] - before
+        return msg
+
+    def recv_into(self, buf):
+        before = tracemalloc.get_traced_memory()[0]
+        n = self._sock.recv_into(buf)
+        self.allocated += tracemalloc.get_traced_memory()[0] - before
+        return n
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+
+    def close(self):
+        self._sock.close()
+
+def measure_echo_allocations(handler, *args, nmessages=200, size=16384):
+    '''
+    Echo nmessages through handler over a socketpair, one at a time, and return
+    the bytes its reads allocated per byte echoed (measured with tracemalloc)
+    and the change in sys.getallocatedblocks()
+    '''
+    server_sock, client_sock = socketpair()
+    probe = AllocationProbe(server_sock)
+    payload = b'x' * size
+    buf = bytearray(size)
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    t = Thread(target=handler, args=(probe, None) + args)
+    t.start()
+    with memoryview(buf) as view:
+        for n in range(nmessages):
+            client_sock.sendall(payload)
+            got = client_sock.recv_into(buf)
+            while got < size:
+                got += client_sock.recv_into(view[got:])
+    client_sock.close()
+    t.join()
+    tracemalloc.stop()
+    return probe.allocated / (nmessages * size), sys.getallocatedblocks() - blocks
+
+def instrumented_echo_server(addr, handler, *args, nworkers=128):
+    '''
+    Thread pool echo server that passes extra arguments to handler
+    '''
+    pool = ThreadPoolExecutor(nworkers)
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.bind(addr)
+    sock.listen(128)
+    while True:
+        client_sock, client_addr = sock.accept()
+        pool.submit(handler, client_sock, client_addr, *args)
+
+def bench_echo_buffers(nclients=50, nmessages=100, size=65536):
+    '''
+    Compare memory allocated per MB echoed with recv() versus pooled recv_into(),
+    and the throughput of both under load
+    '''
+    recv_stats = EchoStats()
+    Thread(target=instrumented_echo_server, daemon=True,
+           args=(('127.0.0.1', 15003), echo_client_counted, recv_stats)).start()
+    pooled_stats = EchoStats()
+    pool = BufferPool(size, stats=pooled_stats)
+    Thread(target=instrumented_echo_server, daemon=True,
+           args=(('127.0.0.1', 15004), echo_client_pooled, pool, pooled_stats)).start()
+    time.sleep(0.5)
+    for name, port, stats, args in [('recv', 15003, recv_stats, (echo_client_counted, EchoStats())),
+                                    ('recv_into', 15004, pooled_stats, (echo_client_pooled, pool, EchoStats()))]:
+        allocated, leftover = measure_echo_allocations(*args)
+        result = asyncio.run(load_test(('127.0.0.1', port), nclients, nmessages, size))
+        time.sleep(0.5)
+        print('{}: {:.3f} bytes allocated per byte echoed, {} blocks left over; under load {:.1f} MB echoed, '
+              '{} pool buffers allocated, {:.0f} conn/s'.format(
+                  name, allocated, leftover, stats.nbytes / 2**20, stats.allocations,
+                  result['connections_per_sec']))
 # 12.8 简单的并行编程
 # 假定你有个Apache web服务器日志目录的gzip压缩包：
 # logs/
@@ -231,6 +1203,7 @@ echo_server(('',15000), 128)
 import gzip
 import io
 import glob
+import re
 
 def find_robots(filename):
     '''
@@ -254,6 +1227,391 @@ def find_all_robots(logdir):
         all_robots.update(robots)
     return all_robots
 
+# find_robots() 的大部分时间花在把每一行解码成 str 和 split() 上。
+# 更快的做法是以 bytes 模式整块读取解压后的数据，用 bytes.find() (底层是 memchr 风格的搜索)
+# 直接定位 /robots.txt，只对命中的行做解码和切分，结果与 find_robots() 完全相同：
+BLOCKSIZE = 1024 * 1024
+_ROBOTS = b'/robots.txt'
+_EOL = re.compile(rb'[\r\n]')
+
+def scan_robots(data):
+    '''
+    Yield the host of every line in data (bytes) whose request path is /robots.txt
+    '''
+    pos = data.find(_ROBOTS)
+    while pos >= 0:
+        start = data.rfind(b'\n', 0, pos) + 1
+        start = max(start, data.rfind(b'\r', start, pos) + 1)
+        m = _EOL.search(data, pos)
+        stop = m.start() if m else len(data)
+        fields = data[start:stop].decode('ascii').split()
+        if len(fields) > 6 and fields[6] == '/robots.txt':
+            yield fields[0]
+        pos = data.find(_ROBOTS, stop)
+
+def find_robots_fast(filename, blocksize=BLOCKSIZE):
+    '''
+    Bytes-mode version of find_robots() that scans decompressed blocks in bulk
+    '''
+    robots = set()
+    with gzip.open(filename) as f:
+        tail = b''
+        for data in iter(lambda: f.read(blocksize), b''):
+            data = tail + data
+            end = data.rfind(b'\n') + 1
+            tail = data[end:]
+            robots.update(scan_robots(data[:end] if end else b''))
+        robots.update(scan_robots(tail))
+    return robots
+
+# 上面的 map() 是串行执行的，只用到一个CPU核心。把 map() 换成进程池就可以并行处理多个文件。
+# 文件数不少于进程数时，每个工作进程处理整个文件(逐块解压，不会把整个文件读进内存)。
+# 只有文件比进程少的时候，才值得在主进程中解压大文件并按行边界切分成块，把块分发给空闲的工作进程。
+# 工作进程返回用换行符拼接的 bytes 而不是 set，这样序列化的开销更小，主进程边收边合并。
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import os
+
+CHUNKSIZE = 16 * 1024 * 1024
+
+def _robots_in_lines(data):
+    '''
+    Find the robots.txt hosts in a block of complete log lines (bytes)
+    '''
+    return '\n'.join(set(scan_robots(data))).encode('ascii')
+
+def _robots_in_file(filename):
+    '''
+    Find the robots.txt hosts in a whole log file (runs in a worker process)
+    '''
+    return '\n'.join(find_robots_fast(filename)).encode('ascii')
+
+def gen_chunks(filename, chunksize=CHUNKSIZE):
+    '''
+    Decompress a gzip file and split it into line-aligned blocks of about chunksize bytes
+    '''
+    with gzip.open(filename) as f:
+        tail = b''
+        for data in iter(lambda: f.read(chunksize), b''):
+            data = tail + data
+            end = data.rfind(b'\n') + 1
+            tail = data[end:]
+            if end:
+                yield data[:end]
+        if tail:
+            yield tail
+
+def find_all_robots_parallel(logdir, workers=None, chunksize=CHUNKSIZE):
+    '''
+    Find all hosts across an entire sequence of files using a process pool.
+    If there are fewer files than workers, files larger than chunksize
+    (compressed) are split into line-aligned chunks to keep every worker busy.
+    '''
+    workers = workers or os.cpu_count()
+    files = glob.glob(logdir+'/*.log.gz')
+    all_robots = set()
+    # Chunking decompresses in this process, which only pays off when workers would otherwise sit idle
+    split = len(files) < workers
+
+    def merge(done):
+        for fut in done:
+            data = fut.result()
+            if data:
+                all_robots.update(host.decode('ascii') for host in data.split(b'\n'))
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for filename in files:
+            if split and os.path.getsize(filename) > chunksize:
+                jobs = ((_robots_in_lines, chunk) for chunk in gen_chunks(filename, chunksize))
+            else:
+                jobs = [(_robots_in_file, filename)]
+            for func, arg in jobs:
+                # Bound the number of chunks held in memory at once
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    merge(done)
+                pending.add(pool.submit(func, arg))
+        merge(pending)
+    return all_robots
+
+# find_robots() 只能回答一个固定的问题。如果要对同一批日志统计状态码分布、热门路径、每个主机的流量等等，
+# 每个问题都要把所有文件重新扫描一遍。更好的办法是用声明式的查询对象来描述要统计的内容，
+# 每个文件只扫描一次就同时回答所有查询。每个查询产生的部分结果都可以合并，所以也能在多个进程间并行计算。
+from collections import Counter
+
+# Positions of the fields in a line of the access log after split()
+LOG_FIELDS = {'host': 0, 'path': 6, 'status': 8, 'bytes': 9}
+
+class CountBy:
+    '''
+    Count the lines for each distinct value of a field
+    '''
+    def __init__(self, field):
+        self.index = LOG_FIELDS[field]
+
+    def new(self):
+        return Counter()
+
+    def add(self, state, fields):
+        state[fields[self.index]] += 1
+
+    def merge(self, state, other):
+        state.update(other)
+        return state
+
+class SumBy(CountBy):
+    '''
+    Sum a numeric field for each distinct value of a key field ('-' counts as 0)
+    '''
+    def __init__(self, field, value):
+        super().__init__(field)
+        self.value_index = LOG_FIELDS[value]
+
+    def add(self, state, fields):
+        value = fields[self.value_index]
+        state[fields[self.index]] += int(value) if value != '-' else 0
+
+class DistinctWhere:
+    '''
+    Collect the distinct values of a field on lines where another field equals value
+    '''
+    def __init__(self, field, where, value):
+        self.index = LOG_FIELDS[field]
+        self.where_index = LOG_FIELDS[where]
+        self.value = value
+
+    def new(self):
+        return set()
+
+    def add(self, state, fields):
+        if fields[self.where_index] == self.value:
+            state.add(fields[self.index])
+
+    def merge(self, state, other):
+        state |= other
+        return state
+
+def _max_index(query):
+    return max(getattr(query, attr) for attr in ('index', 'value_index', 'where_index')
+               if hasattr(query, attr))
+
+def aggregate_log(filename, queries):
+    '''
+    Answer every query in a dict of {name: query} with a single pass over one log file
+    '''
+    states = {name: query.new() for name, query in queries.items()}
+    # Each query only skips the lines too short for the fields it uses itself
+    adders = [(query.add, states[name], _max_index(query) + 1) for name, query in queries.items()]
+    with gzip.open(filename) as f:
+        for line in io.TextIOWrapper(f,encoding='ascii'):
+            fields = line.split()
+            nfields = len(fields)
+            for add, state, needed in adders:
+                if nfields >= needed:
+                    add(state, fields)
+    return states
+
+def merge_aggregates(queries, results):
+    '''
+    Merge a sequence of partial results produced by aggregate_log()
+    '''
+    merged = {name: query.new() for name, query in queries.items()}
+    for states in results:
+        for name, query in queries.items():
+            merged[name] = query.merge(merged[name], states[name])
+    return merged
+
+def aggregate_logs(logdir, queries, workers=None):
+    '''
+    Answer every query across an entire sequence of files using a process pool
+    '''
+    files = glob.glob(logdir+'/*.log.gz')
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(aggregate_log, files, [queries] * len(files))
+        return merge_aggregates(queries, results)
+
+# 例如，下面一次扫描就能同时得到访问过robots.txt的主机、状态码分布、热门路径以及每个主机的流量：
+# queries = {
+#     'robots': DistinctWhere('host', 'path', '/robots.txt'),
+#     'status': CountBy('status'),
+#     'paths': CountBy('path'),
+#     'bytes': SumBy('host', 'bytes'),
+# }
+# results = aggregate_logs('logs', queries)
+# print(results['status'].most_common(), results['paths'].most_common(10))
+
+# 轮转后的日志文件不会再改变，没必要每次都重新解压扫描。可以把每个文件的扫描结果保存在磁盘上，
+# 用路径、大小、修改时间和内容哈希来判断缓存是否有效，这样每晚只需要扫描新增的文件：
+import hashlib
+import shelve
+
+def file_digest(filename, blocksize=BLOCKSIZE):
+    '''
+    Compute the sha1 hex digest of a file's contents
+    '''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class ResultCache:
+    '''
+    A persistent cache of per-file scan results stored in a shelve database.
+    Entries not used for max_age seconds are evicted, as are the least recently
+    used entries beyond max_entries.
+    '''
+    # Each file has a small 'meta:' record (size, mtime, digest, stored) and a 'result:' record.
+    # Access times live in one dict that is read on open and written on close, so a
+    # cache hit or an eviction pass never has to unpickle or rewrite any results.
+    _USED = '__used__'
+
+    def __init__(self, filename, max_entries=10000, max_age=90 * 24 * 3600):
+        self.db = shelve.open(filename)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._used = self.db.get(self._USED, {})
+        # If the last run never reached close(), entries it stored are missing
+        # from _used; fall back to their store time so they can still be evicted
+        for dbkey in self.db.keys():
+            if dbkey.startswith('meta:'):
+                key = dbkey[5:]
+                if key not in self._used:
+                    self._used[key] = self.db[dbkey][3]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_ty, exc_val, tb):
+        self.close()
+
+    def close(self):
+        self.evict()
+        self.db[self._USED] = self._used
+        self.db.close()
+
+    @staticmethod
+    def _key(tag, filename):
+        return '{}:{}'.format(tag, os.path.abspath(filename))
+
+    def _remove(self, key):
+        self.db.pop('meta:' + key, None)
+        self.db.pop('result:' + key, None)
+        self._used.pop(key, None)
+
+    def lookup(self, tag, filename):
+        '''
+        Return the cached result for a file, or None if missing or stale
+        '''
+        key = self._key(tag, filename)
+        meta = self.db.get('meta:' + key)
+        if meta is None:
+            return None
+        size, mtime, digest, stored = meta
+        st = os.stat(filename)
+        if (size, mtime) != (st.st_size, st.st_mtime_ns):
+            # Size or mtime changed.  Only trust the entry if the contents did not.
+            if size != st.st_size or digest != file_digest(filename):
+                self._remove(key)
+                return None
+            self.db['meta:' + key] = (size, st.st_mtime_ns, digest, stored)
+        self._used[key] = time.time()
+        return self.db['result:' + key]
+
+    def store(self, tag, filename, result):
+        key = self._key(tag, filename)
+        st = os.stat(filename)
+        now = time.time()
+        self.db['meta:' + key] = (st.st_size, st.st_mtime_ns, file_digest(filename), now)
+        self.db['result:' + key] = result
+        self._used[key] = now
+
+    def invalidate(self, tag=None, filename=None):
+        '''
+        Drop the entries for a tag, a file (under every tag unless one is given), or everything
+        '''
+        if filename is not None and tag is not None:
+            self._remove(self._key(tag, filename))
+            return
+        prefix = '' if tag is None else tag + ':'
+        path = None if filename is None else os.path.abspath(filename)
+        for key in [key for key in self._used if key.startswith(prefix)]:
+            if path is None or key.split(':', 1)[1] == path:
+                self._remove(key)
+
+    def evict(self):
+        '''
+        Remove entries that are too old, belong to deleted files, or exceed max_entries
+        '''
+        now = time.time()
+        used = []
+        for key, when in list(self._used.items()):
+            if now - when > self.max_age or not os.path.exists(key.split(':', 1)[1]):
+                self._remove(key)
+            else:
+                used.append((when, key))
+        used.sort()
+        for _, key in used[:max(0, len(used) - self.max_entries)]:
+            self._remove(key)
+
+def find_all_robots_cached(logdir, cachefile, workers=None):
+    '''
+    Find all hosts across an entire sequence of files, only scanning files
+    that are not already in the cache
+    '''
+    files = glob.glob(logdir+'/*.log.gz')
+    all_robots = set()
+    with ResultCache(cachefile) as cache:
+        missing = []
+        for filename in files:
+            robots = cache.lookup('robots', filename)
+            if robots is None:
+                missing.append(filename)
+            else:
+                all_robots.update(robots)
+        if missing:
+            with ProcessPoolExecutor(workers) as pool:
+                for filename, robots in zip(missing, pool.map(find_robots_fast, missing)):
+                    cache.store('robots', filename, robots)
+                    all_robots.update(robots)
+    return all_robots
+
+# 下面的基准测试生成一些合成日志，然后比较 1 到 N 个工作进程时的运行时间：
+import random
+import tempfile
+
+def make_fake_logs(logdir, nfiles=8, nlines=200000):
+    '''
+    Write nfiles synthetic access logs with nlines each
+    '''
+    paths = ['/robots.txt', '/ply/', '/favicon.ico', '/blog/atom.xml', '/index.html']
+    for n in range(nfiles):
+        with gzip.open(os.path.join(logdir, '201207{:02d}.log.gz'.format(n+1)), 'wt') as f:
+            for i in range(nlines):
+                host = '10.{}.{}.{}'.format(n, random.randrange(256), random.randrange(256))
+                f.write('{} - - [10/Jul/2012:00:18:50 -0500] "GET {} HTTP/1.1" 200 71\n'.format(
+                    host, random.choice(paths)))
+
+def bench_find_all_robots(nfiles=8, nlines=200000, maxworkers=None):
+    maxworkers = maxworkers or os.cpu_count()
+    with tempfile.TemporaryDirectory() as logdir:
+        make_fake_logs(logdir, nfiles, nlines)
+        start = time.perf_counter()
+        expected = find_all_robots(logdir)
+        print('serial map: {:.2f}s'.format(time.perf_counter() - start))
+        start = time.perf_counter()
+        fast = set()
+        for filename in glob.glob(logdir+'/*.log.gz'):
+            fast.update(find_robots_fast(filename))
+        assert fast == expected
+        print('serial bytes scan: {:.2f}s'.format(time.perf_counter() - start))
+        workers = 1
+        while workers <= maxworkers:
+            start = time.perf_counter()
+            assert find_all_robots_parallel(logdir, workers) == expected
+            print('{} workers: {:.2f}s'.format(workers, time.perf_counter() - start))
+            workers *= 2
+
 if __name__ == '__main__':
     robots = find_all_robots('logs')
     for ipaddr in robots:
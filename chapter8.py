@@ -232,6 +232,174 @@ print(c.perimeter)
 c.area = 25
 print(c.area)
 
+# lazyproperty 把结果写进实例字典，所以不能用在 8.4 节那样定义了 __slots__ 的类上，缓存的值没办法失效，
+# 两个线程同时第一次访问时还会各自计算一遍。下面的 lazyproperty2 是一个数据描述器：
+# 同一个实例同一时刻只有一个线程在计算，其他线程等待并直接使用它的结果；invalidate() (或者 del) 清除缓存的值，
+# ttl 秒之后值会被重新计算。有 __slots__ 的类需要为属性 area 多声明一个名为 _area 的槽来保存结果。
+# 所有缓存的值都登记在 cache_registry 中，report() 给出每个属性缓存了多少个值和它们的大约大小：
+import sys
+import threading
+import time
+
+
+def _approx_size(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class CacheRegistry:
+    def __init__(self):
+        # Reentrant, because an entry may be freed while the lock is held
+        self._lock = threading.RLock()
+        self._stats = {}
+
+    def _add(self, name, size):
+        with self._lock:
+            stats = self._stats.setdefault(name, [0, 0])
+            stats[0] += 1
+            stats[1] += size
+
+    def _remove(self, name, size):
+        with self._lock:
+            stats = self._stats[name]
+            stats[0] -= 1
+            stats[1] -= size
+
+    def report(self):
+        '''
+        Map each property to (number of cached values, approximate bytes)
+        '''
+        with self._lock:
+            return {name: tuple(stats) for name, stats in self._stats.items() if stats[0]}
+
+    def total(self):
+        with self._lock:
+            return tuple(map(sum, zip((0, 0), *self._stats.values())))
+
+
+cache_registry = CacheRegistry()
+
+
+class _CacheEntry:
+    __slots__ = ['value', 'expires', 'name', 'size']
+
+    def __init__(self, name, value, expires):
+        self.value = value
+        self.expires = expires
+        self.name = name
+        self.size = _approx_size(value)
+        cache_registry._add(name, self.size)
+
+    def __del__(self):
+        # Runs once the instance holding the entry is gone or the value is replaced
+        cache_registry._remove(self.name, self.size)
+
+
+class lazyproperty2:
+    def __init__(self, func=None, *, ttl=None):
+        self.func = func
+        self.ttl = ttl
+        self._guard = threading.Lock()
+        self._locks = {}        # id(instance) -> [lock, number of threads using it]
+
+    def __call__(self, func):
+        # Used as @lazyproperty2(ttl=...)
+        self.func = func
+        return self
+
+    def __set_name__(self, owner, name):
+        self.name = owner.__qualname__ + '.' + name
+        for klass in owner.__mro__:
+            slots = klass.__dict__.get('__slots__', ())
+            if '_' + name in ((slots,) if isinstance(slots, str) else slots):
+                self._slot = klass.__dict__['_' + name]
+                self._key = None
+                return
+        if not owner.__dictoffset__:
+            raise TypeError('{} needs a slot named {!r} to cache {}'.format(owner.__name__, '_' + name, name))
+        self._slot = None
+        self._key = name
+
+    def _load(self, instance):
+        if self._slot is None:
+            return instance.__dict__.get(self._key)
+        try:
+            return self._slot.__get__(instance, type(instance))
+        except AttributeError:
+            return None
+
+    def _store(self, instance, entry):
+        if self._slot is None:
+            instance.__dict__[self._key] = entry
+        else:
+            self._slot.__set__(instance, entry)
+
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self
+        entry = self._load(instance)
+        if entry is not None and (entry.expires is None or entry.expires > time.monotonic()):
+            return entry.value
+        # Single flight: one lock per instance, kept only while some thread needs it
+        key = id(instance)
+        with self._guard:
+            lock = self._locks.setdefault(key, [threading.RLock(), 0])
+            lock[1] += 1
+        try:
+            with lock[0]:
+                entry = self._load(instance)
+                if entry is None or (entry.expires is not None and entry.expires <= time.monotonic()):
+                    value = self.func(instance)
+                    expires = None if self.ttl is None else time.monotonic() + self.ttl
+                    entry = _CacheEntry(self.name, value, expires)
+                    self._store(instance, entry)
+                return entry.value
+        finally:
+            with self._guard:
+                lock[1] -= 1
+                if not lock[1]:
+                    del self._locks[key]
+
+    def __set__(self, instance, value):
+        raise AttributeError("can't set attribute")
+
+    def invalidate(self, instance):
+        '''
+        Drop the cached value, so that the next access computes it again
+        '''
+        if self._slot is None:
+            instance.__dict__.pop(self._key, None)
+        else:
+            try:
+                self._slot.__delete__(instance)
+            except AttributeError:
+                pass
+
+    __delete__ = invalidate
+
+
+class Circle2:
+    __slots__ = ['radius', '_area']
+
+    def __init__(self, radius):
+        self.radius = radius
+
+    @lazyproperty2
+    def area(self):
+        print('Computing area')
+        return math.pi * self.radius ** 2
+
+c = Circle2(4.0)
+print(c.area)
+print(c.area)
+print(cache_registry.report())
+del c.area
+print(c.area)
+
 # 8.11 简化数据结构的初始化
 # 你写了很多仅仅用作数据结构的类，不想写太多烦人的 __init__() 函数
 # 可以在一个基类中写一个公用的 __init__() 函数：
@@ -260,6 +428,69 @@ class Circle(Structure1):
 
     def area(self):
         return math.pi * self.radius ** 2
+# Structure1 每创建一个实例都要检查参数个数，再在循环里调用 setattr()，大量创建对象时开销很明显。
+# 可以在定义类的时候根据 _fields 生成一个专门的 __init__()，这样参数检查和关键字参数都由 Python 自己处理。
+# __slots__ 必须在类创建之前放进类字典，所以这里用元类而不是 __init_subclass__()，同时自动加上 8.4 节的 __slots__：
+import keyword
+import sys
+import time
+import tracemalloc
+
+
+def _make_init(fields):
+    for name in fields:
+        if not name.isidentifier() or keyword.iskeyword(name):
+            raise ValueError('Invalid field name: {!r}'.format(name))
+    body = ''.join('    self.{0} = {0}\n'.format(name) for name in fields)
+    namespace = {}
+    exec('def __init__(self, {}):\n{}'.format(', '.join(fields), body), namespace)
+    return namespace['__init__']
+
+
+class StructureMeta(type):
+    def __new__(mcls, clsname, bases, clsdict):
+        fields = clsdict.get('_fields', ())
+        if '__slots__' not in clsdict:
+            # Fields already stored by a base class must not get a second slot
+            inherited = {name for base in bases for klass in base.__mro__
+                         for name in klass.__dict__.get('__slots__', ())}
+            clsdict['__slots__'] = tuple(name for name in fields if name not in inherited)
+        if fields and '__init__' not in clsdict:
+            clsdict['__init__'] = _make_init(fields)
+            clsdict['__init__'].__qualname__ = clsname + '.__init__'
+        return super().__new__(mcls, clsname, bases, clsdict)
+
+
+class Structure2(metaclass=StructureMeta):
+    _fields = []
+
+
+class Stock2(Structure2):
+    _fields = ['name', 'shares', 'price']
+
+
+s = Stock2('ACME', 50, price=91.1)
+print(s.name, s.shares, s.price)
+
+
+def bench_structures(n=1000000):
+    '''
+    Instances per second and bytes per instance of Structure1 against Structure2
+    '''
+    class Stock1(Structure1):
+        _fields = ['name', 'shares', 'price']
+
+    for cls in (Stock1, Stock2):
+        start = time.perf_counter()
+        for i in range(n):
+            cls('ACME', i, 91.1)
+        rate = n / (time.perf_counter() - start)
+        tracemalloc.start()
+        objs = [cls('ACME', i, 91.1) for i in range(n)]
+        size = tracemalloc.get_traced_memory()[0] - sys.getsizeof(objs)
+        tracemalloc.stop()
+        del objs
+        print('{:>8}: {:10.0f} objects/s, {:6.1f} bytes/instance'.format(cls.__name__, rate, size / n))
 # 8.12 定义接口或者抽象基类
 # 使用 abc 模块可以很轻松的定义抽象基类：
 from abc import ABCMeta, abstractmethod